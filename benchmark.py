@@ -0,0 +1,510 @@
+#! /usr/bin/env python3.6
+
+from argparse import ArgumentParser
+from gc import collect
+from json import dump, load
+from multiprocessing import Pool, TimeoutError
+from platform import platform, python_version
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from subprocess import check_output, CalledProcessError, DEVNULL
+from sys import stderr
+from time import perf_counter
+
+from dendropy import Tree, Node, Taxon, TaxonNamespace
+
+from metrics import annotate_rooted_tree, label_graph_annotation, \
+    wave_traversal_annotation, leaf_enumeration_annotation, \
+    two_pass_annotation, array_rooted_labels, array_unrooted_labels, \
+    ArrayTree, LabelTable, get_rooted_vector, vector_dict, euclidean
+
+
+def caterpillar_shape(size, rng=None):
+    """
+    Return the children lists of a caterpillar (ladder) tree: every internal
+    node has a leaf child. It is the deepest tree possible.
+    :param size: number of leaves
+    :param rng: unused, for the same signature as the random shapes
+    :return: a list of children lists, the root being the first node
+    """
+    children = []
+    for leaf in range(size - 1):
+        children.append([len(children) + 1, len(children) + 2])
+        children.append([])
+    children.append([])
+    return children
+
+
+def balanced_shape(size, rng=None):
+    """
+    Return the children lists of a balanced tree: the leaves of every subtree
+    are split between its two children as evenly as possible.
+    :param size: number of leaves
+    :param rng: unused, for the same signature as the random shapes
+    :return: a list of children lists, the root being the first node
+    """
+    children = [[]]
+    stack = [(0, size)]
+    while stack:
+        node, leaves = stack.pop()
+        if leaves == 1:
+            continue
+        for half in (leaves // 2, leaves - leaves // 2):
+            children[node].append(len(children))
+            stack.append((len(children), half))
+            children.append([])
+    return children
+
+
+def kingman_shape(size, rng):
+    """
+    Return the children lists of a Kingman coalescent tree, which joins two
+    random lineages at a time, same as dendropy.simulate.treesim
+    .pure_kingman_tree, but in linear time.
+    :param size: number of leaves
+    :param rng: a random.Random instance
+    :return: a list of children lists, the root being the first node
+    """
+    children = [[] for _ in range(size)]
+    lineages = list(range(size))
+    while len(lineages) > 1:
+        pair = []
+        for _ in range(2):
+            x = rng.randrange(len(lineages))
+            lineages[x], lineages[-1] = lineages[-1], lineages[x]
+            pair.append(lineages.pop())
+        lineages.append(len(children))
+        children.append(pair)
+    return _reverse_shape(children)
+
+
+def birth_death_shape(size, rng, birth_rate=1.0, death_rate=0.5):
+    """
+    Return the children lists of the reconstructed tree of a birth-death
+    process stopped at `size` living lineages, as dendropy.simulate.treesim
+    .birth_death_tree with num_extant_tips, but in linear time. Processes
+    that die out are restarted.
+    :param size: number of leaves
+    :param rng: a random.Random instance
+    :param birth_rate:
+    :param death_rate:
+    :return: a list of children lists, the root being the first node
+    """
+    split = birth_rate / (birth_rate + death_rate)
+    lineages = []
+    while len(lineages) < size:
+        if not lineages:
+            # Started or died out
+            children = [[]]
+            lineages = [0]
+        x = rng.randrange(len(lineages))
+        if rng.random() < split:
+            node = lineages[x]
+            children[node] = [len(children), len(children) + 1]
+            children += [[], []]
+            lineages[x] = len(children) - 2
+            lineages.append(len(children) - 1)
+        else:
+            lineages[x] = lineages[-1]
+            lineages.pop()
+    # Extinct lineages are removed along with the nodes left with a single
+    # child. Children are numbered after their parents, so a reverse pass
+    # sees them first
+    living = set(lineages)
+    kept = [None] * len(children)
+    for node in range(len(children) - 1, -1, -1):
+        if not children[node]:
+            kept[node] = node if node in living else None
+            continue
+        survivors = [kept[x] for x in children[node] if kept[x] is not None]
+        if len(survivors) == 2:
+            kept[node] = node
+            children[node] = survivors
+        elif survivors:
+            kept[node] = survivors[0]
+    return _reverse_shape([children[x] if kept[x] == x else []
+                           for x in range(len(children))], root=kept[0])
+
+
+def _reverse_shape(children, root=None):
+    """
+    Renumber the nodes of a tree so that the root is the first node and
+    every node comes before its children, dropping the nodes not in the tree
+    :param children: a list of children lists
+    :param root: the root, the last node by default
+    :return: a list of children lists
+    """
+    root = len(children) - 1 if root is None else root
+    numbers = {root: 0}
+    order = [root]
+    for node in order:
+        for child in children[node]:
+            numbers[child] = len(order)
+            order.append(child)
+    return [[numbers[x] for x in children[node]] for node in order]
+
+
+SHAPES = {'birth_death': birth_death_shape,
+          'kingman': kingman_shape,
+          'caterpillar': caterpillar_shape,
+          'balanced': balanced_shape}
+
+
+def shape_tree(children):
+    """
+    Make a dendropy tree with leaves named T1, T2... from the children lists
+    of a shape. Trees are built node by node, since parsing Newick strings
+    of deep trees hits the recursion limit.
+    :param children: a list of children lists, the root being the first node
+    :return:
+    """
+    taxa = TaxonNamespace()
+    tree = Tree(taxon_namespace=taxa)
+    nodes = [tree.seed_node]
+    for node in range(1, len(children)):
+        nodes.append(Node())
+    for node, node_children in enumerate(children):
+        for child in node_children:
+            nodes[node].add_child(nodes[child])
+        if not node_children:
+            taxon = Taxon('T{}'.format(len(taxa) + 1))
+            taxa.add_taxon(taxon)
+            nodes[node].taxon = taxon
+    return tree
+
+
+def tree_height(children, unrooted=False):
+    """
+    Return the number of edges on the longest root to leaf path of a shape.
+    The unrooted height is the longest path between leaves: that is the
+    height of the tree rooted at its end, which unrooted labels have.
+    :param children:
+    :param unrooted:
+    :return:
+    """
+    depths = [0] * len(children)
+    for node, node_children in enumerate(children):
+        for child in node_children:
+            depths[child] = depths[node] + 1
+    if not unrooted:
+        return max(depths)
+    heights = [0] * len(children)
+    longest = 0
+    # Parents come before their children
+    for node in range(len(children) - 1, -1, -1):
+        below = sorted((heights[x] + 1 for x in children[node]),
+                       reverse=True)
+        if below:
+            heights[node] = below[0]
+            longest = max(longest, sum(below[:2]))
+    return longest
+
+
+# Labeling methods by name. Each is called with a dendropy tree that has not
+# been labeled yet, the hashing setting and a label table or None
+METHODS = {
+    'rooted': lambda tree, hashing, table:
+        annotate_rooted_tree(tree, hashing=hashing, label_table=table),
+    'array_rooted': lambda tree, hashing, table:
+        array_rooted_labels(ArrayTree.from_dendropy(tree), hashing=hashing,
+                            label_table=table),
+    'twopass': lambda tree, hashing, table:
+        two_pass_annotation(tree, hashing=hashing, label_table=table),
+    'graph': lambda tree, hashing, table:
+        label_graph_annotation(tree, hashing=hashing, label_table=table),
+    'wave': lambda tree, hashing, table:
+        wave_traversal_annotation(tree, hashing=hashing, label_table=table),
+    'leaf': lambda tree, hashing, table:
+        leaf_enumeration_annotation(tree, hashing=hashing, label_table=table),
+    'array_unrooted': lambda tree, hashing, table:
+        array_unrooted_labels(ArrayTree.from_dendropy(tree), hashing=hashing,
+                              label_table=table)}
+ROOTED_METHODS = {'rooted', 'array_rooted'}
+
+
+def _hashing(name):
+    """
+    Return the metrics.py hashing setting for a --hashing value
+    :param name:
+    :return:
+    """
+    return {'none': False, 'md5': True, 'intern': False}.get(name, name)
+
+
+def _label_table(name):
+    """
+    Return a new label table for --hashing intern, None otherwise
+    :param name:
+    :return:
+    """
+    return LabelTable() if name == 'intern' else None
+
+
+def _peak_memory():
+    """
+    Return the peak resident memory of this process in bytes. It includes
+    the memory of gmpy2 numbers, unlike tracemalloc.
+    :return:
+    """
+    return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure(run, repeats, setup=None):
+    """
+    Time a function and measure the memory it needs. The inputs of all runs
+    are made before the memory is measured, so peak_memory includes them,
+    but memory_increase is the growth of the peak while running only. The
+    peak never goes down, so it is the most any single run needed on top of
+    the inputs.
+    :param run: a function without arguments, or of the value of setup
+    :param repeats: number of runs. The fastest one is reported
+    :param setup: a function without arguments that makes the input of a
+    run. It is not timed, and its value is passed to run
+    :return: a dict of the results
+    """
+    inputs = [setup() for _ in range(repeats)] if setup is not None else None
+    collect()
+    memory_before = _peak_memory()
+    times = []
+    for index in range(repeats):
+        start = perf_counter()
+        if inputs is not None:
+            run(inputs[index])
+        else:
+            run()
+        times.append(perf_counter() - start)
+        if inputs is not None:
+            # The memory is reused by the next run
+            inputs[index] = None
+    peak = _peak_memory()
+    return {'seconds': min(times), 'mean_seconds': sum(times) / repeats,
+            'repeats': repeats, 'peak_memory': peak,
+            'memory_increase': peak - memory_before}
+
+
+def labeling_case(case):
+    """
+    Run a labeling benchmark. Every case runs in a fresh process, so that the
+    peak memory is its own.
+    :param case: a (shape, size, method, hashing, seed, repeats) tuple
+    :return: a dict of the case and its results
+    """
+    shape, size, method, hashing, seed, repeats = case
+    children = SHAPES[shape](size, Random(seed))
+    result = {'benchmark': 'labeling', 'shape': shape, 'leaves': size,
+              'method': method, 'hashing': hashing, 'seed': seed}
+    # Labeling changes the tree, so every run gets a new one, and an empty
+    # label table
+    result.update(_measure(
+        lambda x: METHODS[method](x[0], _hashing(hashing), x[1]), repeats,
+        setup=lambda: (shape_tree(children), _label_table(hashing))))
+    return result
+
+
+def distance_case(case):
+    """
+    Run a distance benchmark: make vector dicts of a set of trees and compute
+    the euclidean distances between all pairs of them
+    :param case: a (shape, size, tree count, hashing, seed, repeats) tuple
+    :return: a dict of the case and its results
+    """
+    shape, size, count, hashing, seed, repeats = case
+    rng = Random(seed)
+    label_table = _label_table(hashing)
+    vectors = [get_rooted_vector(shape_tree(SHAPES[shape](size, rng)),
+                                 hashing=_hashing(hashing),
+                                 label_table=label_table)
+               for _ in range(count)]
+
+    def run():
+        dicts = [vector_dict(x) for x in vectors]
+        for i in range(count):
+            for j in range(i + 1, count):
+                euclidean(dicts[i], dicts[j])
+
+    result = {'benchmark': 'distance', 'shape': shape, 'leaves': size,
+              'trees': count, 'hashing': hashing, 'seed': seed}
+    result.update(_measure(run, repeats))
+    return result
+
+
+def _run(pool, function, case, timeout):
+    """
+    Run a case in a worker process
+    :return: the result dict, or None if it took more than timeout seconds
+    """
+    try:
+        return pool.apply_async(function, (case,)).get(timeout)
+    except TimeoutError:
+        return None
+
+
+def _case_key(result):
+    """
+    Return what identifies a case between result files
+    :param result:
+    :return:
+    """
+    return tuple(result.get(x) for x in ('benchmark', 'shape', 'leaves',
+                                         'trees', 'method', 'hashing'))
+
+
+def _commit():
+    """
+    Return the current git commit of the code, if there is one
+    :return:
+    """
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], stderr=DEVNULL,
+                            universal_newlines=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+parser = ArgumentParser("""Time labeling methods and distance computation on
+generated trees, and measure the peak memory they need. The results are
+written to a JSON file, which can be compared with the results for other
+commits with --compare""")
+parser.add_argument('-o', type=str, default='benchmark.json',
+                    help='Output JSON filename')
+parser.add_argument('--shapes', type=str, nargs='*', default=sorted(SHAPES),
+                    choices=sorted(SHAPES), help='Tree shapes')
+parser.add_argument('--sizes', type=int, nargs='*',
+                    default=[100, 1000, 10000, 100000],
+                    help='Numbers of leaves')
+parser.add_argument('--methods', type=str, nargs='*',
+                    default=['rooted', 'graph', 'wave', 'leaf'],
+                    choices=sorted(METHODS),
+                    help="""Labeling methods. 'rooted' is annotate_rooted_tree,
+                    and the unrooted ones are the annotation_method values of
+                    get_unrooted_vector. 'array_rooted' and 'array_unrooted'
+                    label ArrayTrees""")
+parser.add_argument('--hashing', type=str, nargs='*',
+                    default=['none', 'md5', 'intern'],
+                    choices=['none', 'md5', 'int64', 'int128', 'intern'],
+                    help="""Hashing settings. 'intern' labels with a new
+                    LabelTable instead""")
+parser.add_argument('--max-height', type=int, default=24,
+                    help="""Only label trees up to this height unless labels
+                    are interned. Labels are hashed after they are computed,
+                    and exact labels double in length at every level, so
+                    a caterpillar of a hundred leaves cannot be labeled. The
+                    height of unrooted trees is their longest path. With the
+                    default, most cases of 10^3 to 10^5 leaves are skipped
+                    for hashings other than intern, and a summary of the
+                    skipped cases is printed at the end""")
+parser.add_argument('--timeout', type=float, default=600,
+                    help="""Seconds a case may take. Bigger trees are not tried
+                    with a method and shape that timed out""")
+parser.add_argument('--distance-trees', type=int, nargs='*',
+                    default=[10, 30, 100, 300],
+                    help="""Numbers of trees to compute all pairwise distances
+                    between. Empty to skip distance benchmarks""")
+parser.add_argument('--distance-leaves', type=int, default=100,
+                    help='Number of leaves of the trees for distances')
+parser.add_argument('--repeats', type=int, default=3,
+                    help='Number of runs of every case. The fastest counts')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Random seed of tree generation')
+parser.add_argument('--compare', type=str, default=None,
+                    help="""JSON file of earlier results. The speed of every
+                    case present in both is compared""")
+args = parser.parse_args()
+
+
+def too_high(shape, size, method, hashing):
+    """
+    Check if a tree is too high for labels that are not interned, and report
+    if it is
+    :return:
+    """
+    if hashing == 'intern':
+        return False
+    height = tree_height(SHAPES[shape](size, Random(args.seed)),
+                         unrooted=method not in ROOTED_METHODS)
+    if height > args.max_height:
+        print('Skipping {} {} labeling of {} tree of {} leaves: height {} is '
+              'too big'.format(method, hashing, shape, size, height),
+              file=stderr)
+        skipped.append((shape, size, method, hashing))
+        return True
+    return False
+
+
+results = []
+# Cases higher than --max-height
+skipped = []
+timed_out = set()
+# A worker is used for a single case
+pool = Pool(1, maxtasksperchild=1)
+for shape in args.shapes:
+    for size in sorted(args.sizes):
+        for method in args.methods:
+            for hashing in args.hashing:
+                if (shape, method, hashing) in timed_out or \
+                        too_high(shape, size, method, hashing):
+                    continue
+                result = _run(pool, labeling_case,
+                              (shape, size, method, hashing, args.seed,
+                               args.repeats),
+                              args.timeout)
+                if result is None:
+                    # The worker is still busy, and is replaced
+                    pool.terminate()
+                    pool = Pool(1, maxtasksperchild=1)
+                    timed_out.add((shape, method, hashing))
+                    print('{} {} labeling of {} tree of {} leaves timed out'
+                          .format(method, hashing, shape, size), file=stderr)
+                    results.append({'benchmark': 'labeling', 'shape': shape,
+                                    'leaves': size, 'method': method,
+                                    'hashing': hashing, 'seed': args.seed,
+                                    'timed_out': True})
+                    continue
+                print('{benchmark} {shape} {leaves} {method} {hashing}: '
+                      '{seconds:.4f} seconds, {peak_memory} bytes peak'
+                      .format(**result), file=stderr)
+                results.append(result)
+for hashing in args.hashing:
+    shape = 'birth_death'
+    if too_high(shape, args.distance_leaves, 'rooted', hashing):
+        continue
+    for count in sorted(args.distance_trees):
+        result = _run(pool, distance_case,
+                      (shape, args.distance_leaves, count, hashing, args.seed,
+                       args.repeats),
+                      args.timeout)
+        if result is None:
+            pool.terminate()
+            pool = Pool(1, maxtasksperchild=1)
+            print('Distances between {} trees with hashing {} timed out'
+                  .format(count, hashing), file=stderr)
+            break
+        print('{benchmark} {trees} trees {hashing}: {seconds:.4f} seconds, '
+              '{peak_memory} bytes peak'.format(**result), file=stderr)
+        results.append(result)
+pool.terminate()
+if skipped:
+    print('Skipped {} cases higher than --max-height {}, of {} sizes: use '
+          '--hashing intern or a bigger --max-height for them'.format(
+              len(skipped), args.max_height,
+              ' '.join(str(x) for x in sorted({x[1] for x in skipped}))),
+          file=stderr)
+
+with open(args.o, mode='w') as outfile:
+    dump({'commit': _commit(), 'python': python_version(),
+          'platform': platform(), 'arguments': vars(args),
+          'results': results, 'skipped': skipped}, outfile, indent=1)
+print('Results written to {}'.format(args.o), file=stderr)
+
+if args.compare:
+    with open(args.compare) as infile:
+        previous = {_case_key(x): x for x in load(infile)['results']
+                    if 'seconds' in x}
+    for result in results:
+        old = previous.get(_case_key(result))
+        if old is None or 'seconds' not in result:
+            continue
+        print('{}\t{:.4f}\t{:.4f}\t{:.2f}x'.format(
+            ' '.join(str(x) for x in _case_key(result) if x is not None),
+            old['seconds'], result['seconds'],
+            old['seconds'] / result['seconds']))
@@ -1,40 +1,22 @@
 #! /usr/bin/env python3.6
 
 from argparse import ArgumentParser
-from glob import glob
 from collections import OrderedDict
-from gmpy2 import mpz
-from metrics import euclidean, vector_dict
-from multiprocessing import Pool
 from sklearn import manifold
+from sys import exit
+from vector_io import directory_vectors, directory_duplicates, parse_shard, \
+    shard_suffix
+from vector_sets import count_matrix, DistanceEngine, read_matrix_index, \
+    write_matrix_index, SketchEngine, classical_mds, landmark_mds, \
+    unique_rows
+from glob import glob
 import os
 import numpy as np
 
 
-def dict_from_file(file):
-    """
-    Return {value:count} dict for file lines
-    :param file:
-    :return:
-    """
-    return vector_dict((x. rstrip() for x in open(file)))
-
-  
-def dist_between_files(index1, index2, file1, file2, process_zeroes):
-    """
-    Return distance between two vector files
-    :param file1:
-    :param file2:
-    :return:
-    """
-    vector = dict_from_file(file1)
-    vector2 = dict_from_file(file2)
-    return index1, index2, euclidean(vector, vector2, process_zeroes)
-    
-
 parser = ArgumentParser("""Run MDS of vector sets.
-Expects each vector set to be stored as a collection of *.vector files in a
-separate directory""")
+Expects each vector set to be stored as a collection of *.vector or *.bvector
+files, or *.bvectors packed files, in a separate directory""")
 parser.add_argument('-d', type=str, nargs='*', help=""""
                     Vector directories.
                     If absent, data will be loaded from --data_filename.
@@ -45,42 +27,191 @@ parser.add_argument('-z', action='store_true',
                     help='Process zero values')
 parser.add_argument('--no_draw', action='store_true',
                     help="""
-                    Do not draw MDS results. Store the embedding coordinates and
-                    color data in text files instead, to be drawn at other
-                    machine.
+                    Do not draw MDS results. Store the embedding coordinates
+                    and color data in text files instead, to be drawn at
+                    other machine.
                     """)
 parser.add_argument('--data_filename', type=str, default='distances',
                     help='Filename base for data dump')
+parser.add_argument('--batch_size', type=int, default=1024,
+                    help="""
+                    Number of trees per block of the distance matrix. Larger
+                    blocks are faster, but need more memory.
+                    """)
+parser.add_argument('--matrix', type=str, default=None,
+                    help="""
+                    Write the distance matrix to this .npy file tile by tile
+                    instead of keeping it in memory. If the run is interrupted,
+                    it continues from the last finished tile. Row names are
+                    written to FILE.index, and if it exists, only the
+                    distances that involve new vector files are computed.
+                    Vector files are identified by their paths, so those
+                    already in the index should not be changed.
+                    """)
+parser.add_argument('--sketch', action='store_true',
+                    help="""
+                    Fast approximate pass: use the *.sketch.npy files written
+                    by process_tree_set.py --sketch instead of vector files.
+                    Sketch distances approximate those with -z.
+                    """)
+parser.add_argument('--method', type=str, default='smacof',
+                    choices=('smacof', 'classical', 'landmark'),
+                    help="""
+                    Embedding method. 'smacof' is the iterative sklearn MDS,
+                    'classical' is Torgerson MDS, which is much faster for
+                    many trees, and 'landmark' only computes distances to a
+                    few landmark trees instead of the full matrix, so --matrix
+                    is not used.
+                    """)
+parser.add_argument('--landmarks', type=int, default=500,
+                    help='Number of landmark trees for --method landmark')
+parser.add_argument('--shard', type=parse_shard, default=None,
+                    help="""
+                    Only compute the i-th of n shards of the distance matrix,
+                    given as i/n, counting from 0, and exit. Needs --matrix
+                    FILE.npy, and the shard is written to
+                    FILE.shard{i}of{n}.npy with its row names, so that every
+                    shard can be computed on its own machine from the same
+                    vector directories. merge_shards.py --matrix FILE.npy
+                    assembles the matrix, which is then used by this script
+                    with --matrix.
+                    """)
+parser.add_argument('--dedup', action='store_true',
+                    help="""
+                    Compute distances and the embedding only for distinct
+                    vectors, and give every tree the coordinates of its
+                    vector. Classical MDS weights the vectors by the numbers
+                    of trees, so its result is the same as without --dedup.
+                    """)
 args = parser.parse_args()
+if args.shard and (not args.matrix or args.method == 'landmark'):
+    parser.error('--shard needs --matrix, and is not used by landmark MDS')
 
 lengths = None
 coords = None
 if args.d:
     # If data were supplied
     lengths = OrderedDict()
-    files = []
+    names = []
+    # Numbers of trees every vector stands for, from process_tree_set.py
+    # --dedup
+    weights = []
     for dir in args.d:
         if not os.path.exists(dir):
             raise ValueError('Nonetexistent directory {}'.format(dir))
-        dir_files = glob(dir+'/*.vector')
-        lengths[dir] = len(dir_files)
-        files += dir_files
-        # for file in files:
-        #     vectors.append(dict_from_file(file))
-    diss = np.ndarray(shape=(sum(lengths.values()), sum(lengths.values())),
-                      dtype=np.float32)
-    queries = []
-    for index, file in enumerate(files):
-        diss[index, index] = 0
-        for index2 in range(index+1, len(files)):
-            queries.append([index, index2, file, files[index2], args.z])
-    pool = Pool(os.cpu_count())
-    results = pool.starmap(dist_between_files, queries, chunksize=1)
-    for result in results:
-        diss[result[0], result[1]] = result[2]
-        diss[result[1], result[0]] = result[2]
-    mds = manifold.MDS(dissimilarity='precomputed')
-    coords = mds.fit(diss).embedding_
+
+    def sources():
+        """
+        Yield vectors from all directories, counting them on the way. Text
+        and binary vector files can be mixed
+        """
+        for dir in args.d:
+            lengths[dir] = 0
+            duplicates = directory_duplicates(dir)
+            for name, counts in directory_vectors(dir):
+                names.append(name)
+                weights.append(duplicates.get(os.path.basename(name), 1))
+                lengths[dir] += weights[-1]
+                # Text files give string labels and binary ones give numbers,
+                # so labels are compared as strings, as LabelIndex does
+                yield {str(x): y for x, y in counts.items()}
+
+    def sketches():
+        """
+        Return sketches from all directories, counting them on the way
+        """
+        result = []
+        for dir in args.d:
+            lengths[dir] = 0
+            for filename in sorted(glob(os.path.join(dir, '*.sketch.npy'))):
+                rows = np.load(filename)
+                names.extend('{}#{}'.format(filename, x)
+                             for x in range(len(rows)))
+                # Sketches are written for every tree, duplicates included
+                weights.extend([1] * len(rows))
+                lengths[dir] += len(rows)
+                result.append(rows)
+            if not lengths[dir]:
+                raise ValueError('No sketches in {}'.format(dir))
+        return np.concatenate(result)
+
+    if args.sketch:
+        engine = SketchEngine(sketches())
+    else:
+        # Every file is read only once, and all distances are computed from
+        # the resulting count matrix
+        _, counts = count_matrix(sources())
+        engine = DistanceEngine(counts, process_zeroes=args.z)
+    # Weights of the vectors, and of the distinct ones with --dedup
+    vector_weights = weights = np.array(weights, dtype=np.int64)
+    inverse = None
+    if args.dedup:
+        first, inverse = unique_rows(engine.matrix)
+        weights = np.bincount(inverse, weights=vector_weights).astype(
+            np.int64)
+        names = [names[x] for x in first]
+        if args.sketch:
+            engine = SketchEngine(engine.matrix[first])
+        else:
+            engine = DistanceEngine(engine.matrix[first],
+                                    process_zeroes=args.z)
+        print('Found {} distinct vectors among {} trees'.format(
+            len(names), weights.sum()))
+    if args.shard:
+        root, extension = os.path.splitext(args.matrix)
+        shard_name = root + shard_suffix(args.shard) + extension
+        tiles = engine.distance_shard(shard_name, args.shard,
+                                      batch_size=args.batch_size)
+        write_matrix_index(shard_name + '.index', names,
+                           engine.process_zeroes)
+        print('{} tiles of the distance matrix written to {}'.format(
+            tiles, shard_name))
+        exit()
+    if args.method == 'landmark':
+        # No full distance matrix is needed
+        coords = landmark_mds(engine, landmarks=args.landmarks,
+                              batch_size=args.batch_size)
+    else:
+        previous = None
+        if args.matrix and os.path.exists(args.matrix + '.index'):
+            previous, zeroes = read_matrix_index(args.matrix + '.index')
+            if zeroes != engine.process_zeroes:
+                print('Distances in {} were computed with different settings, '
+                      'recomputing'.format(args.matrix))
+                previous = None
+        if previous == names and \
+                not os.path.exists(args.matrix + '.progress'):
+            # A complete matrix of the same vectors, eg from an earlier run or
+            # assembled from shards
+            print('Using distances from {}'.format(args.matrix))
+            diss = np.load(args.matrix, mmap_mode='r')
+        elif previous is not None:
+            rows = {name: row for row, name in enumerate(names)}
+            reused = {row: rows[name] for row, name in enumerate(previous)
+                      if name in rows}
+            print('Reusing distances between {} of {} vectors'.format(
+                len(reused), len(names)))
+            diss = engine.update_distance_file(args.matrix, args.matrix,
+                                               reused,
+                                               batch_size=args.batch_size)
+        elif args.matrix:
+            diss = engine.distance_file(args.matrix,
+                                        batch_size=args.batch_size)
+        else:
+            diss = engine.distance_matrix(batch_size=args.batch_size)
+        if args.matrix:
+            write_matrix_index(args.matrix + '.index', names,
+                               engine.process_zeroes)
+        if args.method == 'classical':
+            coords = classical_mds(diss, batch_size=args.batch_size,
+                                   weights=weights)
+        else:
+            mds = manifold.MDS(dissimilarity='precomputed')
+            coords = mds.fit(diss).embedding_
+    # Back to a row per tree
+    if inverse is not None:
+        coords = coords[inverse]
+    coords = np.repeat(coords, vector_weights, axis=0)
     if args.no_draw:
         # Data exist, but need to be dumped, not stored
         with open(args.data_filename+'.lengths', mode='w') as lenfile:
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3.6
+
+from argparse import ArgumentParser
+from glob import glob
+import os
+
+import numpy as np
+
+from vector_io import read_shard_manifest, merge_shard_manifests, \
+    PackedVectors, PackedVectorWriter, SketchWriter, write_duplicates
+from vector_sets import merge_distance_shards, read_matrix_index, \
+    write_matrix_index
+
+
+parser = ArgumentParser("""Assemble the outputs of sharded runs.
+With -t, the shards of process_tree_set.py --shard for a tree file are checked
+to cover every tree exactly once with the same settings, and their packed
+vectors, sketches and tree counts are merged into the files an unsharded run
+would have written. With --matrix, the shards of mds_vectors.py --shard are
+checked and assembled into the distance matrix""")
+parser.add_argument('-t', type=str, help='Tree file processed in shards')
+parser.add_argument('--matrix', type=str,
+                    help='Distance matrix file (.npy) computed in shards')
+parser.add_argument('--clean', action='store_true',
+                    help='Remove the shard files after merging them')
+args = parser.parse_args()
+if not args.t and not args.matrix:
+    parser.error('Nothing to merge: use -t or --matrix')
+
+if args.t:
+    base = args.t.split('.')[0]
+    manifest_names = sorted(glob(base + '.shard*of*.manifest'))
+    manifests = [read_shard_manifest(x) for x in manifest_names]
+    trees = merge_shard_manifests(manifests)
+    method, hashing, threshold, file_format, sketch_width, dedup = \
+        manifests[0]['settings'].split(' ')
+    sketch_width = int(sketch_width)
+    shard_bases = [x[:-len('.manifest')] for x in manifest_names]
+    first_trees = sorted(set(trees.values()))
+    if file_format == 'packed':
+        packed_name = base + '.bvectors'
+        shard_vectors = [PackedVectors(x + '.bvectors') for x in shard_bases]
+        positions = {}
+        for shard, (vectors, manifest) in enumerate(zip(shard_vectors,
+                                                        manifests)):
+            written = [int(x) for x in vectors.tree_indices]
+            if sorted(written) != sorted(set(manifest['trees'].values())):
+                raise ValueError('{}.bvectors does not have the vectors of '
+                                 'its manifest'.format(shard_bases[shard]))
+            positions.update((x, (shard, y)) for y, x in enumerate(written))
+        header = shard_vectors[0].header
+        with PackedVectorWriter(packed_name, method=header['method'],
+                                hashing=header['hashing'],
+                                width=header['width']) as writer:
+            for tree in first_trees:
+                shard, position = positions[tree]
+                writer.add_records(shard_vectors[shard].records_for(position),
+                                   tree)
+        del shard_vectors
+        print('{} packed vectors written to {}'.format(len(first_trees),
+                                                       packed_name))
+    else:
+        mask = base + (file_format == 'binary' and '_tree{}.bvector' or
+                       '_tree{}.vector')
+        missing = [x for x in first_trees
+                   if not os.path.exists(mask.format(x))]
+        if missing:
+            raise ValueError('{} vector files are missing, eg {}'.format(
+                len(missing), mask.format(missing[0])))
+        print('All {} vector files are present'.format(len(first_trees)))
+    if sketch_width:
+        sketch_name = base + '.sketch.npy'
+        with SketchWriter(sketch_name, sketch_width) as writer:
+            for shard_base, manifest in zip(shard_bases, manifests):
+                rows = np.load(shard_base + '.sketch.npy', mmap_mode='r')
+                for tree in sorted(manifest['trees']):
+                    writer.add(rows[tree], tree)
+                del rows
+        print('Sketches of {} trees written to {}'.format(len(trees),
+                                                          sketch_name))
+    if dedup == 'dedup':
+        counts = {}
+        for tree in trees.values():
+            counts[tree] = counts.get(tree, 0) + 1
+        if file_format == 'packed':
+            names = {'{}#{}'.format(os.path.basename(packed_name), x): y
+                     for x, y in counts.items()}
+        else:
+            names = {os.path.basename(mask.format(x)): y
+                     for x, y in counts.items()}
+        write_duplicates(base + '.duplicates', names)
+        print('Tree counts written to {}'.format(base + '.duplicates'))
+    if args.clean:
+        for shard_base in shard_bases:
+            for extension in ('.manifest', '.bvectors', '.sketch.npy',
+                              '.duplicates'):
+                if os.path.exists(shard_base + extension):
+                    os.remove(shard_base + extension)
+
+if args.matrix:
+    root, extension = os.path.splitext(args.matrix)
+    shard_names = sorted(glob(root + '.shard*of*' + extension))
+    names = None
+    for shard_name in shard_names:
+        shard_rows = read_matrix_index(shard_name + '.index')
+        if names is None:
+            names = shard_rows
+        elif shard_rows != names:
+            raise ValueError('{} has different rows than {}'.format(
+                shard_name, shard_names[0]))
+    if names is None:
+        raise ValueError('No shards of {}'.format(args.matrix))
+    matrix, process_zeroes = merge_distance_shards(args.matrix, shard_names)
+    if process_zeroes != names[1] or len(matrix) != len(names[0]):
+        raise ValueError('Shard indices do not match the shards')
+    write_matrix_index(args.matrix + '.index', names[0], process_zeroes)
+    if os.path.exists(args.matrix + '.progress'):
+        # Left from an unsharded run
+        os.remove(args.matrix + '.progress')
+    print('Distance matrix of {} trees written to {}'.format(len(matrix),
+                                                             args.matrix))
+    if args.clean:
+        for shard_name in shard_names:
+            for extension in ('', '.progress', '.index'):
+                os.remove(shard_name + extension)
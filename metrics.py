@@ -4,13 +4,16 @@ The basic idea is from "Metric on phylogenetic tree shapes". All the labels are
 stored in node.
 """
 
-from collections import defaultdict
-from gmpy2 import mpz
-from hashlib import md5
+from array import array
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from gmpy2 import mpz, to_binary
+from hashlib import blake2b, md5
 from math import sqrt
+import re
+from time import perf_counter
 
 from dendropy import Tree
-from networkx import DiGraph, topological_sort
 
 
 def label_parent(k, j):
@@ -23,97 +26,617 @@ def label_parent(k, j):
     return k * (k-1) // 2 + j + 1
 
 
-def annotate_rooted_tree(tree, hashing=False):
+class LabelTable:
+    """
+    A hash-consing table that replaces CP-labels with dense integer IDs.
+
+    Every distinct (k, j) pair of children labels gets the next free ID the
+    first time it is seen, starting with 2 (leaves are 1). The resulting labels
+    are small and collision-free, but they only make sense for the trees that
+    were labeled with the same table. To keep vectors from different runs
+    comparable, the table is saved after a run and loaded before the next one.
+
+    The mapping can be a `multiprocessing.Manager().dict()` shared by several
+    processes (see `LabelTable.shared`). In that case, new IDs are assigned
+    under the lock, and every process keeps a local copy of the pairs it has
+    already seen to avoid talking to the manager every time. The copy is not
+    pickled, so the table should be sent to a process once (eg by a Pool
+    initializer) rather than with every task.
+    """
+    def __init__(self, mapping=None, lock=None):
+        self.mapping = {} if mapping is None else mapping
+        self.lock = lock
+        self._local = {} if lock else self.mapping
+
+    @classmethod
+    def shared(cls, manager, table=None):
+        """
+        Create a table that can be passed to other processes.
+        :param manager: a started multiprocessing.Manager
+        :param table: a LabelTable to copy the pairs from
+        :return:
+        """
+        mapping = manager.dict(table.mapping if table else {})
+        return cls(mapping, manager.Lock())
+
+    def __getstate__(self):
+        # The local copy is per-process and can be rebuilt from the mapping
+        return {'mapping': self.mapping, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.__init__(state['mapping'], state['lock'])
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def combine(self, k, j):
+        """
+        Return the ID for a node given the IDs of its children.
+        Used instead of `label_parent`.
+        :return:
+        """
+        k, j = int(k), int(j)
+        if j > k:
+            k, j = j, k
+        key = (k, j)
+        try:
+            return self._local[key]
+        except KeyError:
+            pass
+        if self.lock is None:
+            label = len(self.mapping) + 2
+            self.mapping[key] = label
+            return label
+        with self.lock:
+            label = self.mapping.get(key)
+            if label is None:
+                label = len(self.mapping) + 2
+                self.mapping[key] = label
+        self._local[key] = label
+        return label
+
+    def save(self, filename):
+        """
+        Write the table to a file as one tab-separated pair per line, in the
+        order of their IDs.
+        :param filename:
+        :return:
+        """
+        pairs = sorted(self.mapping.items(), key=lambda x: x[1])
+        with open(filename, mode='w') as outfile:
+            for (k, j), _ in pairs:
+                print('{}\t{}'.format(k, j), file=outfile)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a table written by `LabelTable.save`
+        :param filename:
+        :return:
+        """
+        mapping = {}
+        for label, line in enumerate(open(filename), start=2):
+            k, j = line.split('\t')
+            mapping[(int(k), int(j))] = label
+        return cls(mapping)
+
+
+class LabelCache:
+    """
+    A bounded cache of CP-labels and their digests, shared by all the trees
+    labeled in a process.
+
+    Tree sets tend to share many subtrees, and without a cache every tree
+    recomputes the same big labels and hashes them again. The cache maps
+    (k, j) pairs of children labels to the parent label, and (hashing, label)
+    pairs to digests. When it holds more than `maxsize` entries, the least
+    recently used one is dropped. Hits and misses are counted to see whether
+    the cache is worth its memory on a given tree set.
+
+    It is activated with `set_label_cache`, after which every labeling function
+    uses it. Interned labels (see LabelTable) are not cached, as the table is a
+    dictionary already.
+    """
+    def __init__(self, maxsize=1 << 20):
+        if maxsize < 1:
+            raise ValueError('Cache size should be positive')
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get(self, key, function, *args):
+        """
+        Return a cached value for a key, calling `function(*args)` on a miss
+        :param key:
+        :param function:
+        :param args:
+        :return:
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = function(*args)
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return value
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def combine(self, k, j):
+        """
+        Cached `label_parent`
+        :return:
+        """
+        if j > k:
+            k, j = j, k
+        return self._get((k, j), label_parent, k, j)
+
+    def digest(self, hashing, function):
+        """
+        Return a cached version of a label hash
+        :param hashing: name of the hash, part of the cache key
+        :param function: the hash function, eg one of LABEL_HASHES values
+        :return:
+        """
+        def cached_digest(label):
+            return self._get((hashing, label), function, label)
+        return cached_digest
+
+    def stats(self):
+        """
+        Return cache statistics as a dict
+        :return:
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self),
+                'maxsize': self.maxsize,
+                'hit_rate': lookups and self.hits / lookups or 0.0}
+
+    def clear(self):
+        """
+        Drop all entries and reset statistics
+        :return:
+        """
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+# The LabelCache used by the labeling functions in this process, if any
+_label_cache = None
+
+
+def set_label_cache(cache):
+    """
+    Make all the labeling in this process use a given LabelCache.
+    :param cache: a LabelCache or None to stop caching
+    :return: the previously active cache
+    """
+    global _label_cache
+    previous, _label_cache = _label_cache, cache
+    return previous
+
+
+def get_label_cache():
+    """
+    Return the LabelCache active in this process or None
+    :return:
+    """
+    return _label_cache
+
+
+class LabelProfiler:
+    """
+    Time spent in every phase of tree processing, and counters of the work
+    done, for finding where the time goes.
+
+    Phases are timed with `phase(name)`, and may be nested: 'combine' (making
+    labels from children labels, big integer arithmetic unless the labels are
+    interned) and 'hash' are timed within whatever phase labels a tree. Labels
+    and hashes are counted as they are asked for, along with the longest label:
+    with a LabelCache, the counts include its hits, and its own stats tell how
+    many of them were computed.
+    Timing every label costs time too, so profiles are only comparable with
+    each other.
+
+    It is activated with `set_label_profiler`, after which every labeling
+    function reports to it.
+    """
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.max_label_bits = 0
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a block of code: `with profiler.phase('parse'): ...`
+        :param name:
+        :return:
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += perf_counter() - start
+
+    def count(self, name, number=1):
+        """
+        Add to a counter
+        :param name:
+        :param number:
+        :return:
+        """
+        self.counts[name] += number
+
+    def combine(self, function):
+        """
+        Return a version of a label combining function that is timed as the
+        'combine' phase and counts 'labels'
+        :param function: eg label_parent or LabelTable.combine
+        :return:
+        """
+        def profiled_combine(k, j):
+            start = perf_counter()
+            label = function(k, j)
+            self.times['combine'] += perf_counter() - start
+            self.counts['labels'] += 1
+            bits = label.bit_length()
+            if bits > self.max_label_bits:
+                self.max_label_bits = bits
+            return label
+        return profiled_combine
+
+    def digest(self, function):
+        """
+        Return a version of a label hash that is timed as the 'hash' phase and
+        counts 'hashes'
+        :param function: eg one of LABEL_HASHES values
+        :return:
+        """
+        def profiled_digest(label):
+            start = perf_counter()
+            value = function(label)
+            self.times['hash'] += perf_counter() - start
+            self.counts['hashes'] += 1
+            return value
+        return profiled_digest
+
+    def stats(self):
+        """
+        Return the profile as a dict of phase times in seconds, counters, the
+        longest label in bits and the peak memory of the process in bytes, or
+        None where it is not known
+        :return:
+        """
+        try:
+            from resource import getrusage, RUSAGE_SELF
+            peak_memory = getrusage(RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            peak_memory = None
+        return {'times': dict(self.times), 'counts': dict(self.counts),
+                'max_label_bits': self.max_label_bits,
+                'peak_memory': peak_memory}
+
+    def clear(self):
+        """
+        Reset all times and counters
+        :return:
+        """
+        self.times.clear()
+        self.counts.clear()
+        self.max_label_bits = 0
+
+
+# The LabelProfiler the labeling functions in this process report to, if any
+_label_profiler = None
+
+
+def set_label_profiler(profiler):
+    """
+    Make all the labeling in this process report to a given LabelProfiler.
+    :param profiler: a LabelProfiler or None to stop profiling
+    :return: the previously active profiler
+    """
+    global _label_profiler
+    previous, _label_profiler = _label_profiler, profiler
+    return previous
+
+
+def get_label_profiler():
+    """
+    Return the LabelProfiler active in this process or None
+    :return:
+    """
+    return _label_profiler
+
+
+@contextmanager
+def profiled_phase(name):
+    """
+    Time a block of code as a phase of the active LabelProfiler, if any
+    :param name:
+    :return:
+    """
+    if _label_profiler is None:
+        yield
+    else:
+        with _label_profiler.phase(name):
+            yield
+
+
+# Label hashes
+
+
+def md5_label_hash(label):
+    """
+    Return the MD5 hex digest of the label's decimal representation.
+    This is the original hash, kept for compatibility with existing vectors.
+    :param label:
+    :return:
+    """
+    return md5(str(label).encode(encoding='utf-8')).hexdigest()
+
+
+def int64_label_hash(label):
+    """
+    Return a 64-bit integer digest of the label's binary representation
+    :param label:
+    :return:
+    """
+    return int.from_bytes(blake2b(to_binary(mpz(label)),
+                                  digest_size=8).digest(),
+                          'big')
+
+
+def int128_label_hash(label):
+    """
+    Return a 128-bit integer digest of the label's binary representation
+    :param label:
+    :return:
+    """
+    return int.from_bytes(blake2b(to_binary(mpz(label)),
+                                  digest_size=16).digest(),
+                          'big')
+
+
+LABEL_HASHES = {'md5': md5_label_hash,
+                'int64': int64_label_hash,
+                'int128': int128_label_hash}
+
+# Digest sizes for integer hashes, used to keep digests apart from exact labels
+LABEL_HASH_BITS = {'int64': 64, 'int128': 128}
+
+
+def get_label_hash(hashing, hash_threshold=None):
+    """
+    Return a label hash function given the `hashing` kwarg value.
+
+    If `hash_threshold` is set, the function is adaptive: labels of at most
+    `hash_threshold` bits are returned as they are, and only the longer ones are
+    hashed. Integer digests then get their highest bit set, so they never
+    coincide with an exact label. This requires the threshold to be less than
+    the digest size.
+    Digests are cached if a LabelCache is active, see set_label_cache, and
+    profiled if a LabelProfiler is, see set_label_profiler.
+    :param hashing: False for no hashing, True for MD5 or a key of LABEL_HASHES
+    :param hash_threshold: None to hash every label or the maximum bit length
+    of a label that is kept exact
+    :return: a function or None if no hashing is necessary
+    """
+    if not hashing:
+        return None
+    if hashing is True:
+        hashing = 'md5'
+    try:
+        digest = LABEL_HASHES[hashing]
+    except KeyError:
+        raise ValueError('Unknown label hash {}'.format(hashing))
+    if _label_cache is not None:
+        digest = _label_cache.digest(hashing, digest)
+    if _label_profiler is not None:
+        # Cached digests count too, as cached labels do in _combiner
+        digest = _label_profiler.digest(digest)
+    if hash_threshold is None:
+        return digest
+    bits = LABEL_HASH_BITS.get(hashing)
+    if bits is None:
+        def adaptive_digest(label):
+            if label.bit_length() <= hash_threshold:
+                return label
+            return digest(label)
+    elif hash_threshold < bits:
+        top_bit = 1 << (bits - 1)
+
+        def adaptive_digest(label):
+            if label.bit_length() <= hash_threshold:
+                return label
+            return digest(label) | top_bit
+    else:
+        raise ValueError('Hash threshold should be below {} bits for {}'.format(
+            bits, hashing))
+    return adaptive_digest
+
+
+def label_sort_key(label):
+    """
+    Sorting key for vectors that may mix exact integer labels and MD5 strings
+    :param label:
+    :return:
+    """
+    return isinstance(label, str), label
+
+
+def _combiner(label_table):
+    """
+    Return a function that makes a label given children labels
+    :param label_table: a LabelTable or None for the plain CP-labels
+    :return:
+    """
+    if label_table is not None:
+        combine = label_table.combine
+    elif _label_cache is not None:
+        combine = _label_cache.combine
+    else:
+        combine = label_parent
+    if _label_profiler is not None:
+        combine = _label_profiler.combine(combine)
+    return combine
+
+
+def annotate_rooted_tree(tree, hashing=False, hash_threshold=None,
+                         label_table=None):
     """
     Take a rooted phylogenetic tree and annotate it using the Colijn-Plazotta
     metric (precisely as in the paper)
     Modifies the tree object passed to it, returns nothing
     :param tree: A tree to be annotated
-    :param hashing: Boolean. If True, the labels are set to MD5 hashes of the
+    :param hashing: If True, the labels are set to MD5 hashes of the
     CP-labels instead of the labels themselves. This is useful for large trees
-    where labels get prohibitively high.
+    where labels get prohibitively high. 'int64' or 'int128' make integer
+    digests instead, see LABEL_HASHES.
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable. If supplied, node labels are interned IDs
+    instead of CP-labels.
     :return:
     """
     assert isinstance(tree, Tree)
+    combine = _combiner(label_table)
+    digest = get_label_hash(hashing, hash_threshold)
     for node in tree.postorder_node_iter():
         if not node.child_nodes():
             node.annotations['CP-label'].value = mpz(1)
         else:
             k, j = (x.annotations['CP-label'].value for x in node.child_nodes())
-            label = label_parent(k, j)
+            label = combine(k, j)
             node.annotations['CP-label'].value = label
             if hashing:
-                # Hashing children values using MD5 if necessary
+                # Hashing children values if necessary
                 # The children values are not gonna be necessary anymore if the
                 # current node value was set
                 for child in node.child_nodes():
                     child.annotations['CP-label'].value =\
-                            md5(str(child.annotations['CP-label'].value).
-                                encode(encoding='utf-8')).hexdigest()
+                            digest(child.annotations['CP-label'].value)
     # Hashing root separately because it has no parent
     if hashing:
         tree.seed_node.annotations['CP-label'].value = \
-            md5(str(tree.seed_node.annotations['CP-label'].value).encode(
-                encoding='utf-8')).hexdigest()
+            digest(tree.seed_node.annotations['CP-label'].value)
 
 
-def get_root_label(tree, hashing=False):
+def get_root_label(tree, hashing=False, hash_threshold=None,
+                   label_table=None):
     """
     Return the root value of a tree.
     If not annotated, annotate it first
-    :param tree: A tree whose label is to be produced
-    :param hashing: if True, return MD5 hash of the label
+    :param tree: A tree whose label is to be produced. May be an ArrayTree
+    :param hashing: if True, return MD5 hash of the label. May also be a key
+    of LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable to intern labels with
     :return: 
     """
+    if isinstance(tree, ArrayTree):
+        return array_rooted_labels(tree, hashing=hashing,
+                                   hash_threshold=hash_threshold,
+                                   label_table=label_table)[tree.root]
     r = tree.seed_node.annotations['CP-label'].value
     if r:
         return r
     else:
-        annotate_rooted_tree(tree, hashing=hashing)
+        annotate_rooted_tree(tree, hashing=hashing,
+                             hash_threshold=hash_threshold,
+                             label_table=label_table)
         return tree.seed_node.annotations['CP-label'].value
 
 
-def get_rooted_vector(tree, hashing=False):
+def get_rooted_vector(tree, hashing=False, backend='dendropy',
+                      label_table=None, hash_threshold=None):
     """
     For an annotated rooted tree, collect labels into a vector
-    :param tree: a tree whose label vector is to be produced
-    :param hashing: if True, return MD5s of labels
+    :param tree: a tree whose label vector is to be produced. If it is an
+    ArrayTree, the array backend is used regardless of `backend`
+    :param hashing: if True, return MD5s of labels. May also be a key of
+    LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param backend: either 'dendropy' (labels are stored in node annotations)
+    or 'array' (the tree is converted to an ArrayTree and left unannotated)
+    :param label_table: a LabelTable to intern labels with
     :return: 
     """
+    if isinstance(tree, ArrayTree) or backend == 'array':
+        if not isinstance(tree, ArrayTree):
+            tree = ArrayTree.from_dendropy(tree)
+        return sorted(array_rooted_labels(tree, hashing=hashing,
+                                          hash_threshold=hash_threshold,
+                                          label_table=label_table),
+                      key=label_sort_key)
     if not tree.seed_node.annotations['CP-label'].value:
-        annotate_rooted_tree(tree, hashing=hashing)
+        annotate_rooted_tree(tree, hashing=hashing,
+                             hash_threshold=hash_threshold,
+                             label_table=label_table)
     r = []
     for node in tree.postorder_node_iter():
         r.append(node.annotations['CP-label'].value)
-    r = sorted(r)
+    r = sorted(r, key=label_sort_key)
     return r
 
 
 # Unrooted version
 
 
-def get_unrooted_vector(tree, hashing=False, annotation_method='graph'):
+def get_unrooted_vector(tree, hashing=False, annotation_method='graph',
+                        backend='dendropy', label_table=None,
+                        hash_threshold=None):
     """
     Collect labels from an unrooted tree.
     If the tree was not labeled before, it is labelled using the method supplied
     in the `annotation_method` kwarg.
-    :param tree: a tree whose labels are to be returned
-    :param hashing: if True, return MD5s of labels
-    :param annotation_method: either 'wave' or 'graph'. 'graph' is faster, but
-    requires networkx.
+    :param tree: a tree whose labels are to be returned. If it is an ArrayTree,
+    the array backend is used regardless of `backend`
+    :param hashing: if True, return MD5s of labels. May also be a key of
+    LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param annotation_method: 'twopass', 'graph', 'wave' or 'leaf'. 'twopass'
+    is the fastest, 'graph' requires networkx. Ignored by the array backend.
+    :param backend: either 'dendropy' (labels are stored in node annotations)
+    or 'array' (the tree is converted to an ArrayTree and left unannotated)
+    :param label_table: a LabelTable to intern labels with
     :return:
     """
+    if isinstance(tree, ArrayTree) or backend == 'array':
+        if not isinstance(tree, ArrayTree):
+            tree = ArrayTree.from_dendropy(tree)
+        down, up = array_unrooted_labels(tree, hashing=hashing,
+                                         hash_threshold=hash_threshold,
+                                         label_table=label_table)
+        return sorted((x for x in down + up if x is not None),
+                      key=label_sort_key)
     functions = {'graph': label_graph_annotation,
                  'wave': wave_traversal_annotation,
-                 'leaf': leaf_enumeration_annotation}
+                 'leaf': leaf_enumeration_annotation,
+                 'twopass': two_pass_annotation}
     if not tree.seed_node.annotations['CPM-labels'].value == -1:
-        functions[annotation_method](tree, hashing=hashing)
+        functions[annotation_method](tree, hashing=hashing,
+                                     hash_threshold=hash_threshold,
+                                     label_table=label_table)
     r = []
     for node in tree.preorder_node_iter():
         if node is not tree.seed_node:
             r += list(node.annotations['CPM-labels'].value.values())
-    print(r)
-    return list(sorted(r))
+    return list(sorted(r, key=label_sort_key))
 
 
 def get_neighbours(node):
@@ -132,15 +655,21 @@ def get_neighbours(node):
 #  Two functions that define the wave traversal unrooted labeling
 
 
-def _process_node_wave(wave, hashing=False):
+def _process_node_wave(wave, hashing=False, combine=label_parent, hashed=None,
+                       hash_threshold=None):
     """
     Use a bunch of nodes to try and give CPM-labels to their neighbours.
 
     Takes an iterable of nodes (assumes them to have the 'CPM-labels'
     annotation) and returns a tuple of nodes that got some new labels this run.
     :param wave:
+    :param combine: a function that returns a label given children labels
+    :param hashed: a set of (node, neighbour) pairs whose labels were hashed
     :return:
     """
+    digest = get_label_hash(hashing, hash_threshold)
+    if hashed is None:
+        hashed = set()
     next_wave = set()
     for node in wave:
         for neighbour in node.annotations['CPM-labels'].value.keys():
@@ -150,7 +679,7 @@ def _process_node_wave(wave, hashing=False):
                                if x != neighbour and
                                node.annotations['CPM-labels'].value[x])
                 if len(others) == len(node.annotations['CPM-labels'].value) - 1:
-                    v = label_parent(*others)
+                    v = combine(*others)
                     neighbour.annotations['CPM-labels'].value[node] = v
                     next_wave.add(neighbour)
         if hashing:
@@ -167,20 +696,23 @@ def _process_node_wave(wave, hashing=False):
                     if neighbour2.annotations['CPM-labels'].value[node]:
                         count += 1
                 if count >= len(node.annotations['CPM-labels'].value.keys()) -1\
-                        and not isinstance(
-                        node.annotations['CPM-labels'].value[neighbour], str):
-                    node.annotations['CPM-labels'].value[neighbour] = md5(str(
-                        node.annotations['CPM-labels'].value[neighbour]).encode(
-                        encoding='utf-8')).hexdigest()
+                        and (node, neighbour) not in hashed:
+                    node.annotations['CPM-labels'].value[neighbour] = digest(
+                        node.annotations['CPM-labels'].value[neighbour])
+                    hashed.add((node, neighbour))
     return tuple(next_wave)
     
 
-def wave_traversal_annotation(tree, hashing=False):
+def wave_traversal_annotation(tree, hashing=False, hash_threshold=None,
+                              label_table=None):
     """
     Annotate a tree with three labels per node.
     Uses a wave traversal algorithm which is, frankly, an ugly bunch of hacks.
     Not recommended except when networkx is unavailable.
     :param tree: 
+    :param label_table: a LabelTable to intern labels with
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
     :return: 
     """
     # Creating correct CPM-labels dicts for each node
@@ -211,9 +743,13 @@ def wave_traversal_annotation(tree, hashing=False):
     # smaller trees).
     # The initial set is composed from leaves' parents who get 1s from leaves.
     wave = tuple(parents)
+    hashed = set()
     cont = True
     while cont:
-        next_wave = _process_node_wave(wave, hashing=hashing)
+        next_wave = _process_node_wave(wave, hashing=hashing,
+                                       hash_threshold=hash_threshold,
+                                       combine=_combiner(label_table),
+                                       hashed=hashed)
         if len(next_wave) > 0:
             wave = next_wave
         else:
@@ -241,15 +777,23 @@ class LabelGraphNode:
         return hash((self.home_node, self.target_node))
 
 
-def label_graph_annotation(tree, hashing = True):
+def label_graph_annotation(tree, hashing = True, hash_threshold=None,
+                           label_table=None):
     """
     Annotate the tree using label graph.
     It's a graph such that every CPM label corresponds to a node and
     the labels that require other labels to be built are their descendants.
     :param tree: a Tree that has CPM-labels markup
-    :param hashing: if True, return MD5 hashes of labels instead of themselves
+    :param hashing: if True, return MD5 hashes of labels instead of themselves.
+    May also be a key of LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable to intern labels with
     :return:
     """
+    from networkx import DiGraph, topological_sort
+    combine = _combiner(label_table)
+    digest = get_label_hash(hashing, hash_threshold)
     ### Walk over a tree, hanging graph nodes on their corresponding tree nodes
     for node in tree.preorder_node_iter():
         if not node.annotations['CPM-nodes'].value:
@@ -275,15 +819,17 @@ def label_graph_annotation(tree, hashing = True):
 
     ### Walk over the tree again, collecting nodes and assembling them to a graph
     ### Necessary so that all nodes do exist by the time a graph is assembled
-    label_graph = DiGraph()
-    for node in tree.postorder_node_iter():
-        if node is tree.seed_node:
-            continue
-        for label_node in node.annotations['CPM-nodes'].value.values():
-            label_graph.add_node(label_node)
-            for other_node in label_node.target_node.annotations['CPM-nodes'].value.values():
-                if other_node.target_node is not node:
-                    label_graph.add_edge(other_node, label_node)
+    with profiled_phase('graph'):
+        label_graph = DiGraph()
+        for node in tree.postorder_node_iter():
+            if node is tree.seed_node:
+                continue
+            for label_node in node.annotations['CPM-nodes'].value.values():
+                label_graph.add_node(label_node)
+                for other_node in label_node.target_node.annotations[
+                        'CPM-nodes'].value.values():
+                    if other_node.target_node is not node:
+                        label_graph.add_edge(other_node, label_node)
 
     ### Traverse the graph, calculating values in nodes
     for label_node in topological_sort(label_graph):
@@ -291,7 +837,7 @@ def label_graph_annotation(tree, hashing = True):
         if label_node.value is None:
             parents = tuple(label_graph.predecessors(label_node))
             # There are, by definition, two parents for each non-parentless node
-            label_node.value = label_parent(parents[0].value, parents[1].value)
+            label_node.value = combine(parents[0].value, parents[1].value)
             if hashing:
                 # Try and hash node's parents
                 for parent in parents:
@@ -300,12 +846,10 @@ def label_graph_annotation(tree, hashing = True):
                         if child.value is None:
                             can_hash = False
                     if can_hash:
-                        parent.value = md5(str(parent.value).
-                                           encode(encoding='utf-8')).hexdigest()
+                        parent.value = digest(parent.value)
                 # If the node is not a parent, hash itself
                 if list(label_graph.successors(label_node)) == []:
-                    label_node.value = md5(str(label_node.value).
-                                           encode(encoding='utf-8')).hexdigest()
+                    label_node.value = digest(label_node.value)
 
     ### Walk over the tree the third time, collecting values from nodes
     #TODO: Discard nodes on the tree for memory saving and general clarity
@@ -318,48 +862,64 @@ def label_graph_annotation(tree, hashing = True):
                  for x in node.annotations['CPM-nodes'].value}
 
 
-def recursive_label(node, direction, hashing):
+def iterative_label(node, direction, labels, neighbours, combine=label_parent,
+                    digest=None):
     """
     An internal function for leaf_enumeration_annotation
-    Essentially a lazy label calculation
+    Essentially a lazy label calculation. The directed edges whose labels are
+    still missing are kept on an explicit stack instead of the call stack, so
+    the depth of a tree is not limited by the recursion limit. Every directed
+    edge is labeled only once.
     :param node:
     :param direction:
-    :param hashing:
+    :param labels: a dict of CPM-labels dicts for all nodes
+    :param neighbours: a dict of neighbour tuples for all nodes
+    :param combine: a function that returns a label given children labels
+    :param digest: a label hash function or None if no hashing is necessary
     :return:
     """
-    # print(direction)
-    # print(node.annotations)
-    if node.annotations['CPM-labels'].value[direction] is None:
-        next_nodes = [x for x in direction.annotations['CPM-labels'].value if x is not node]
-        node.annotations['CPM-labels'].value[direction] = \
-            label_parent(recursive_label(direction,
-                                         next_nodes[0],
-                                         hashing),
-                         recursive_label(direction,
-                                         next_nodes[1],
-                                         hashing))
-        if hashing:
-            # Checking if the values in next_nodes are hashable.
-            if next_nodes[0].annotations['CPM-labels'].value[direction] is not None:
-                direction.annotations['CPM-labels'].value[next_nodes[1]] = md5(
-                    str(direction.annotations['CPM-labels'].value[next_nodes[1]]
-                        ).encode(encoding='utf-8')).hexdigest()
-            if next_nodes[1].annotations['CPM-labels'].value[direction] is not None:
-                direction.annotations['CPM-labels'].value[next_nodes[0]] = md5(
-                    str(direction.annotations['CPM-labels'].value[next_nodes[0]]
-                        ).encode(encoding='utf-8')).hexdigest()
-    return node.annotations['CPM-labels'].value[direction]
+    stack = [(node, direction)]
+    while stack:
+        current, target = stack[-1]
+        if labels[current][target] is not None:
+            stack.pop()
+            continue
+        first, second = (x for x in neighbours[target] if x is not current)
+        target_labels = labels[target]
+        k, j = target_labels[first], target_labels[second]
+        if k is None or j is None:
+            if k is None:
+                stack.append((target, first))
+            if j is None:
+                stack.append((target, second))
+            continue
+        labels[current][target] = combine(k, j)
+        stack.pop()
+        if digest:
+            # A label can be hashed once both labels that use it are set
+            if labels[first][target] is not None:
+                target_labels[second] = digest(j)
+            if labels[second][target] is not None:
+                target_labels[first] = digest(k)
+    return labels[node][direction]
 
 
-def leaf_enumeration_annotation(tree, hashing=False):
+def leaf_enumeration_annotation(tree, hashing=False, hash_threshold=None,
+                                label_table=None):
     """
     Annotate the unrooted tree using leaf enumeration.
-    This approach uses a recursive function, so it may fail if the distance
-    between two furthest nodes in a tree is above recursion limit.
+    For every leaf, the label directed towards the rest of the tree is
+    calculated lazily, which labels all the other directed edges on the way.
     :param tree: a Tree that has CPM-labels markup
-    :param hashing: if True, return MD5 hashes of labels instead of themselves
+    :param hashing: if True, return MD5 hashes of labels instead of themselves.
+    May also be a key of LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable to intern labels with
     :return:
     """
+    combine = _combiner(label_table)
+    digest = get_label_hash(hashing, hash_threshold)
     # Creating correct CPM-labels dicts for each node
     for node in tree.preorder_node_iter():
         if not node.annotations['CPM-labels'].value:
@@ -372,21 +932,718 @@ def leaf_enumeration_annotation(tree, hashing=False):
     del (a.annotations['CPM-labels'].value[root])
     b.annotations['CPM-labels'].value[a] = b.annotations['CPM-labels'].value[root]
     del (b.annotations['CPM-labels'].value[root])
+    # Looking annotations up once, rather than on every step
+    labels = {node: node.annotations['CPM-labels'].value
+              for node in tree.preorder_node_iter() if node is not root}
+    neighbours = {node: tuple(labels[node]) for node in labels}
     # Populating the initial CPM labels for leaf parents
     for node in tree.leaf_node_iter():
-        # Each node should have only one parent, but these being dicts I cannot
-        # just address neighbours[0]
-        for parent in node.annotations['CPM-labels'].value:
-            parent.annotations['CPM-labels'].value[node] = mpz(1)
+        for parent in neighbours[node]:
+            labels[parent][node] = mpz(1)
     # For each leaf, compute the label directed towards the rest of the tree
     for node in tree.leaf_node_iter():
-        for parent in node.annotations['CPM-labels'].value:
-            recursive_label(node, parent, hashing=hashing)
-            node.annotations['CPM-labels'].value[parent] = md5(str(
-                        node.annotations['CPM-labels'].value[parent]).encode(
-                        encoding='utf-8')).hexdigest()
+        for parent in neighbours[node]:
+            iterative_label(node, parent, labels, neighbours, combine=combine,
+                            digest=digest)
+            if digest:
+                labels[node][parent] = digest(labels[node][parent])
+    # Marking the tree as labeled, as in the other annotation functions
+    root.annotations['CPM-labels'].value = -1
+
+
+# Two-pass unrooted labeling
+
+
+def two_pass_annotation(tree, hashing=False, hash_threshold=None,
+                        label_table=None):
+    """
+    Annotate the unrooted tree in two passes, as in rerooting DP.
+    The postorder pass gives every subtree its rooted label, and the preorder
+    pass gets the label of the rest of the tree for every node from its
+    parent's one and its sibling's subtree. Runs in O(n) and needs no graph.
+    :param tree: a binary Tree
+    :param hashing: if True, return MD5 hashes of labels instead of themselves.
+    May also be a key of LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable to intern labels with
+    :return:
+    """
+    nodes = list(tree.postorder_node_iter())
+    indices = {node: index for index, node in enumerate(nodes)}
+    down, up = array_unrooted_labels(ArrayTree.from_dendropy(tree),
+                                     hashing=hashing,
+                                     hash_threshold=hash_threshold,
+                                     label_table=label_table)
+    root = tree.seed_node
+    for index, node in enumerate(nodes):
+        if node is root:
+            # Marks the tree as labeled, as in the other annotation functions
+            node.annotations['CPM-labels'].value = -1
+            continue
+        labels = {child: down[indices[child]] for child in node.child_nodes()}
+        if node.parent_node is root:
+            # A hack around a root node, which does not really exist
+            for sibling in root.child_nodes():
+                if sibling is not node:
+                    labels[sibling] = down[indices[sibling]]
+        else:
+            labels[node.parent_node] = up[index]
+        node.annotations['CPM-labels'].value = labels
+
+
+# Array-backed trees
+
+
+class ArrayTree:
+    """
+    A compact binary tree topology stored in flat index arrays.
+
+    Nodes are numbered in postorder, so children always have lower indices than
+    their parents and the root is the last node. `parent[i]` is -1 for the
+    root, `left[i]` and `right[i]` are -1 for leaves, and `leaf[i]` is 1 for
+    leaves and 0 otherwise. Neither names nor branch lengths are kept, and no
+    labels are ever stored on the tree itself.
+    """
+    def __init__(self, parent, left, right):
+        if not len(parent) == len(left) == len(right):
+            raise ValueError('Index arrays should have equal lengths')
+        self.parent = parent
+        self.left = left
+        self.right = right
+        self.leaf = bytearray(1 if x < 0 else 0 for x in left)
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def root(self):
+        return len(self.parent) - 1
+
+    @property
+    def leaf_count(self):
+        return sum(self.leaf)
+
+    @classmethod
+    def from_dendropy(cls, tree):
+        """
+        Build an ArrayTree from a dendropy Tree.
+        :param tree: a binary dendropy Tree
+        :return:
+        """
+        indices = {}
+        parent, left, right = array('l'), array('l'), array('l')
+        for node in tree.postorder_node_iter():
+            index = len(parent)
+            indices[node] = index
+            parent.append(-1)
+            children = node.child_nodes()
+            if not children:
+                left.append(-1)
+                right.append(-1)
+            elif len(children) == 2:
+                left.append(indices[children[0]])
+                right.append(indices[children[1]])
+                parent[indices[children[0]]] = index
+                parent[indices[children[1]]] = index
+            else:
+                raise ValueError('Only binary trees can be labelled')
+        return cls(parent, left, right)
+
+    @classmethod
+    def from_newick(cls, string):
+        """
+        Build an ArrayTree directly from a single Newick string.
+        Names, branch lengths and [comments] are skipped without being parsed.
+        :param string: a Newick tree, optionally terminated by a semicolon
+        :return:
+        """
+        parent, left, right = array('l'), array('l'), array('l')
+        # Each element is a list of children indices for an unclosed clade
+        open_clades = []
+        expect_node = True
+        position = 0
+        length = len(string)
+        while position < length:
+            char = string[position]
+            if char == '[':
+                position = string.index(']', position) + 1
+                continue
+            if char.isspace():
+                position += 1
+                continue
+            if char == '(':
+                if not expect_node:
+                    raise ValueError('Unexpected ( at {}'.format(position))
+                open_clades.append([])
+                position += 1
+                continue
+            if expect_node:
+                # Anything but an opening bracket means a leaf, possibly
+                # an unnamed one
+                index = len(parent)
+                parent.append(-1)
+                left.append(-1)
+                right.append(-1)
+                if open_clades:
+                    open_clades[-1].append(index)
+                expect_node = False
+                if char in ',)':
+                    continue
+            if char == ',':
+                expect_node = True
+                position += 1
+            elif char == ')':
+                if not open_clades:
+                    raise ValueError('Unbalanced ) at {}'.format(position))
+                children = open_clades.pop()
+                if len(children) != 2:
+                    raise ValueError('Only binary trees can be labelled')
+                index = len(parent)
+                parent.append(-1)
+                left.append(children[0])
+                right.append(children[1])
+                parent[children[0]] = index
+                parent[children[1]] = index
+                if open_clades:
+                    open_clades[-1].append(index)
+                position += 1
+            elif char == ';':
+                break
+            else:
+                position = _skip_newick_label(string, position)
+        if open_clades or not parent:
+            raise ValueError('Incomplete Newick string')
+        return cls(parent, left, right)
+
+
+def _skip_newick_label(string, position):
+    """
+    Return the position right after a node name and/or branch length
+    :param string:
+    :param position:
+    :return:
+    """
+    length = len(string)
+    while position < length:
+        char = string[position]
+        if char == "'":
+            # Quoted name, with '' standing for a literal quote
+            position += 1
+            while True:
+                position = string.index("'", position) + 1
+                if position < length and string[position] == "'":
+                    position += 1
+                else:
+                    break
+            continue
+        if char in '(),;[':
+            break
+        position += 1
+    return position
+
+
+def _hash_labels(labels, indices, digest):
+    """
+    Replace labels at given indices with their hashes
+    :param labels:
+    :param indices:
+    :param digest: a label hash function
+    :return:
+    """
+    for index in indices:
+        labels[index] = digest(labels[index])
+
+
+def array_rooted_labels(tree, hashing=False, hash_threshold=None,
+                        label_table=None):
+    """
+    Return CP-labels for every node of an ArrayTree.
+    The labels are returned as a list aligned with node indices. The tree
+    itself is not modified.
+    :param tree: an ArrayTree
+    :param hashing: if True, return MD5 hashes of labels. May also be a key of
+    LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable to intern labels with
+    :return:
+    """
+    combine = _combiner(label_table)
+    digest = get_label_hash(hashing, hash_threshold)
+    left, right = tree.left, tree.right
+    labels = [None] * len(tree)
+    for index in range(len(tree)):
+        if left[index] < 0:
+            labels[index] = mpz(1)
+        else:
+            labels[index] = combine(labels[left[index]], labels[right[index]])
+            if hashing:
+                _hash_labels(labels, (left[index], right[index]), digest)
+    if hashing:
+        _hash_labels(labels, (tree.root,), digest)
+    return labels
+
+
+def array_unrooted_labels(tree, hashing=False, hash_threshold=None,
+                          label_table=None):
+    """
+    Return CPM-labels for every directed edge of an ArrayTree.
+    Returns two lists aligned with node indices. `down[i]` is the label of the
+    subtree below node i, ie the one seen from its parent. `up[i]` is the label
+    of the rest of the tree as seen from node i. The root, which does not exist
+    in the unrooted tree, gets None in both. Its children get None for `up`,
+    because they share an edge and their `up` labels are each other's `down`.
+    :param tree: an ArrayTree
+    :param hashing: if True, return MD5 hashes of labels. May also be a key of
+    LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable to intern labels with
+    :return:
+    """
+    combine = _combiner(label_table)
+    digest = get_label_hash(hashing, hash_threshold)
+    parent, left, right = tree.parent, tree.left, tree.right
+    root = tree.root
+    if tree.leaf[root]:
+        raise ValueError('A single node tree has no edges to label')
+    down = [None] * len(tree)
+    up = [None] * len(tree)
+    # Postorder pass: rooted labels of every subtree
+    for index in range(root):
+        if left[index] < 0:
+            down[index] = mpz(1)
+        else:
+            down[index] = combine(down[left[index]], down[right[index]])
+    # Preorder pass: labels of the complements, each from the parent's
+    # complement and the sibling subtree
+    for index in range(root, -1, -1):
+        if left[index] < 0:
+            continue
+        a, b = left[index], right[index]
+        if index == root:
+            pass
+        elif parent[index] == root:
+            # The root is suppressed, so the sibling of this node is the whole
+            # rest of the tree
+            up_label = down[left[root] if right[root] == index else right[root]]
+            up[a] = combine(up_label, down[b])
+            up[b] = combine(up_label, down[a])
+        else:
+            up[a] = combine(up[index], down[b])
+            up[b] = combine(up[index], down[a])
+        if hashing and index != root:
+            # Exact values around this node are not needed anymore
+            if up[index] is not None:
+                _hash_labels(up, (index,), digest)
+            _hash_labels(down, (a, b), digest)
+    if hashing:
+        _hash_labels(down, (left[root], right[root]), digest)
+        _hash_labels(up, (x for x in range(root)
+                          if tree.leaf[x] and up[x] is not None), digest)
+    return down, up
 
 
+# All rootings
+
+def all_rootings(tree, hashing=False, hash_threshold=None, label_table=None,
+                 vectors=True):
+    """
+    Yield the CP-vector for every rooting of an unrooted tree.
+
+    The labels of both directions of every edge are computed once (see
+    `array_unrooted_labels`). Rooting the tree on an edge makes its root label
+    a combination of the edge's two labels, and the subtree of every other node
+    is the one away from the root: the same as in the original rooting, except
+    for the nodes on the path to the original root, whose subtrees become the
+    other direction of their edges. So every vector is a copy of the original
+    one with that path replaced, and the root labels alone take O(n) overall.
+    :param tree: a binary dendropy Tree or ArrayTree. Its root is suppressed,
+    as in the unrooted labeling
+    :param hashing: if True, return MD5 hashes of labels. May also be a key of
+    LABEL_HASHES
+    :param hash_threshold: if set, only labels longer than this many bits are
+    hashed, see get_label_hash
+    :param label_table: a LabelTable to intern labels with
+    :param vectors: if False, only root labels are yielded
+    :return: yields a (node, root label, vector) tuple for each of 2n - 3
+    edges. Node is the ArrayTree index of the node below the edge in `tree`,
+    and vector is sorted as by `get_rooted_vector`, or None if `vectors` is
+    False
+    """
+    if not isinstance(tree, ArrayTree):
+        tree = ArrayTree.from_dendropy(tree)
+    combine = _combiner(label_table)
+    digest = get_label_hash(hashing, hash_threshold)
+    output = digest or (lambda label: label)
+    parent, root = tree.parent, tree.root
+    down, up = array_unrooted_labels(tree, label_table=label_table)
+    # The two children of the suppressed root share an edge
+    first, second = tree.left[root], tree.right[root]
+    up[first], up[second] = down[second], down[first]
+    if vectors:
+        original = [output(label) for label in down[:root]]
+        reversed_labels = [output(label) for label in up[:root]]
+    for node in range(root):
+        if node == second:
+            continue
+        root_label = output(combine(down[node], up[node]))
+        vector = None
+        if vectors:
+            vector = list(original)
+            child, ancestor = node, parent[node]
+            while ancestor != root:
+                vector[ancestor] = reversed_labels[child]
+                child, ancestor = ancestor, parent[ancestor]
+            vector.append(root_label)
+            vector.sort(key=label_sort_key)
+        yield node, root_label, vector
+
+
+# Incremental relabeling
+
+class LabeledTree:
+    """
+    A labeled binary tree that can be rearranged with SPR and NNI moves,
+    relabeling only the parts of the tree that have changed.
+
+    Nodes keep their ArrayTree indices, but after a move they are not in
+    postorder anymore, and the root may change. Exact labels are stored and
+    `hashing` is only applied to the labels returned, so that the stored ones
+    can be combined again. Every move returns the vector delta: a
+    {label: change} dict to add to the counts of the previous tree (see
+    `counts`), without zero entries.
+
+    In the rooted case only the labels of the nodes on the paths from the
+    pruning and the regrafting points to the root change, so a move costs
+    O(depth). In the unrooted case, every directed edge that points towards
+    the moved subtree changes as well, which is about half of them, so moves
+    are O(n); only the changed labels are hashed, though.
+    """
+    def __init__(self, tree, unrooted=False, hashing=False,
+                 hash_threshold=None, label_table=None):
+        if not isinstance(tree, ArrayTree):
+            tree = ArrayTree.from_dendropy(tree)
+        if tree.leaf[tree.root]:
+            raise ValueError('A single node tree cannot be rearranged')
+        self.parent = list(tree.parent)
+        self.left = list(tree.left)
+        self.right = list(tree.right)
+        self.root = tree.root
+        self.unrooted = unrooted
+        self.combine = _combiner(label_table)
+        self.digest = get_label_hash(hashing, hash_threshold)
+        # Labels of the subtrees below every node, and for unrooted trees of
+        # the rest of the tree as seen from every node
+        self.down = array_rooted_labels(tree, label_table=label_table)
+        self.up = unrooted and self._up_labels() or None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _output(self, label):
+        return label if self.digest is None else self.digest(label)
+
+    def _sibling(self, node):
+        parent = self.parent[node]
+        return self.right[parent] if self.left[parent] == node \
+            else self.left[parent]
+
+    def _replace_child(self, parent, old, new):
+        """
+        Put `new` in place of the `old` child of `parent`, or make it the
+        root if `parent` is -1
+        """
+        if parent < 0:
+            self.root = new
+        elif self.left[parent] == old:
+            self.left[parent] = new
+        else:
+            self.right[parent] = new
+        self.parent[new] = parent
+
+    def _path_to_root(self, node):
+        path = []
+        while node >= 0:
+            path.append(node)
+            node = self.parent[node]
+        return path
+
+    def _up_labels(self):
+        """
+        Return the labels of the rest of the tree for every node, as
+        `array_unrooted_labels` does
+        :return:
+        """
+        parent, left, right, down = self.parent, self.left, self.right, \
+            self.down
+        up = [None] * len(self)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if left[node] < 0:
+                continue
+            a, b = left[node], right[node]
+            if node == self.root:
+                pass
+            elif parent[node] == self.root:
+                # The root is suppressed, so the sibling of this node is the
+                # whole rest of the tree
+                rest = down[self._sibling(node)]
+                up[a] = self.combine(rest, down[b])
+                up[b] = self.combine(rest, down[a])
+            else:
+                up[a] = self.combine(up[node], down[b])
+                up[b] = self.combine(up[node], down[a])
+            stack.append(a)
+            stack.append(b)
+        return up
+
+    @staticmethod
+    def _edge_labels(node, root, parent, down, up):
+        """
+        Return the unrooted labels that belong to a node: that of the edge to
+        its parent in both directions, except for the suppressed root
+        """
+        if node == root:
+            return ()
+        if parent[node] == root:
+            return down[node],
+        return down[node], up[node]
+
+    def counts(self):
+        """
+        Return the vector of the tree as a {label: count} dict
+        :return:
+        """
+        result = defaultdict(int)
+        for node in range(len(self)):
+            if self.unrooted:
+                labels = self._edge_labels(node, self.root, self.parent,
+                                           self.down, self.up)
+            else:
+                labels = self.down[node],
+            for label in labels:
+                result[self._output(label)] += 1
+        return dict(result)
+
+    def array_tree(self):
+        """
+        Return the current topology as an ArrayTree
+        :return:
+        """
+        order = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if self.left[node] >= 0:
+                stack.append(self.left[node])
+                stack.append(self.right[node])
+        # Reversed preorder with children pushed left first is a postorder
+        order.reverse()
+        indices = {node: index for index, node in enumerate(order)}
+        parent, left, right = array('l'), array('l'), array('l')
+        for node in order:
+            parent.append(indices.get(self.parent[node], -1))
+            left.append(indices.get(self.left[node], -1))
+            right.append(indices.get(self.right[node], -1))
+        return ArrayTree(parent, left, right)
+
+    def spr(self, node, target):
+        """
+        Prune the subtree of `node` and regraft it onto the edge above
+        `target`. The parent of `node` is moved along with it, becoming the
+        parent of both `node` and `target`.
+        :param node: index of the root of the moved subtree
+        :param target: index of a node outside that subtree, other than the
+        parent of `node`
+        :return: the vector delta
+        """
+        parent = self.parent
+        if node == self.root:
+            raise ValueError('The root cannot be pruned')
+        pruned = parent[node]
+        if target == pruned or node in self._path_to_root(target):
+            raise ValueError('Cannot regraft {} onto {}'.format(node, target))
+        if self.unrooted:
+            old_parent, old_root, old_up = list(parent), self.root, self.up
+            old_down = list(self.down)
+        # Take the parent of `node` out and put it above `target`
+        sibling = self._sibling(node)
+        grandparent = parent[pruned]
+        self._replace_child(grandparent, pruned, sibling)
+        self._replace_child(parent[target], target, pruned)
+        if self.left[pruned] == node:
+            self.right[pruned] = target
+        else:
+            self.left[pruned] = target
+        parent[target] = pruned
+        # Only the ancestors of the changed nodes need new labels. Paths
+        # end at the root, so their positions from the end are depths
+        depths = {}
+        for path in (self._path_to_root(pruned),
+                     grandparent >= 0 and self._path_to_root(grandparent)
+                     or []):
+            for position, ancestor in enumerate(path):
+                depths[ancestor] = len(path) - position
+        delta = defaultdict(int)
+        for changed in sorted(depths, key=depths.get, reverse=True):
+            if not self.unrooted:
+                delta[self._output(self.down[changed])] -= 1
+            self.down[changed] = self.combine(self.down[self.left[changed]],
+                                              self.down[self.right[changed]])
+            if not self.unrooted:
+                delta[self._output(self.down[changed])] += 1
+        if self.unrooted:
+            self.up = self._up_labels()
+            for index in range(len(self)):
+                old = self._edge_labels(index, old_root, old_parent, old_down,
+                                        old_up)
+                new = self._edge_labels(index, self.root, parent, self.down,
+                                        self.up)
+                if old != new:
+                    for label in old:
+                        delta[self._output(label)] -= 1
+                    for label in new:
+                        delta[self._output(label)] += 1
+        return {label: change for label, change in delta.items() if change}
+
+    def nni(self, node):
+        """
+        Swap a subtree with the sibling of its parent
+        :param node: index of a node whose parent is not the root
+        :return: the vector delta
+        """
+        pruned = self.parent[node]
+        if node == self.root or pruned == self.root:
+            raise ValueError('NNI needs a grandparent of {}'.format(node))
+        # Swapping `node` with its aunt is moving the aunt next to the
+        # sibling of `node`
+        return self.spr(self._sibling(pruned), self._sibling(node))
+
+
+# Topology fingerprints
+
+_LEAF_SHAPE = blake2b(b'leaf', digest_size=16).digest()
+
+
+def _shape_pair(a, b):
+    """
+    Return the fingerprint of a clade given the fingerprints of its children
+    :param a:
+    :param b:
+    :return:
+    """
+    if b < a:
+        a, b = b, a
+    return blake2b(a + b, digest_size=16).digest()
+
+
+def topology_fingerprint(tree, rooted=True):
+    """
+    Return a canonical fingerprint of a tree topology as a hex string.
+
+    Trees with the same shape get the same fingerprint regardless of names,
+    branch lengths and the order of children. Clades are fingerprinted by
+    hashing the sorted fingerprints of their children, which is much cheaper
+    than computing their labels. Unrooted fingerprints are the smallest ones
+    among all the rootings on an edge, so they do not depend on where the tree
+    was rooted. Equal fingerprints mean equal vectors unless there is a 128-bit
+    hash collision.
+    :param tree: a binary dendropy Tree or ArrayTree
+    :param rooted: whether the root is a part of the topology
+    :return:
+    """
+    if not isinstance(tree, ArrayTree):
+        tree = ArrayTree.from_dendropy(tree)
+    parent, left, right = tree.parent, tree.left, tree.right
+    root = tree.root
+    down = [None] * len(tree)
+    for index in range(len(tree)):
+        if left[index] < 0:
+            down[index] = _LEAF_SHAPE
+        else:
+            down[index] = _shape_pair(down[left[index]], down[right[index]])
+    if rooted or tree.leaf[root]:
+        return down[root].hex()
+    # The edge between the children of the suppressed root
+    smallest = down[root]
+    up = [None] * len(tree)
+    for index in range(root - 1, -1, -1):
+        if parent[index] == root:
+            a, b = left[root], right[root]
+            up[index] = down[b if a == index else a]
+        else:
+            a, b = left[parent[index]], right[parent[index]]
+            up[index] = _shape_pair(up[parent[index]],
+                                    down[b if a == index else a])
+            smallest = min(smallest, _shape_pair(down[index], up[index]))
+    return smallest.hex()
+
+
+# Newick files
+
+
+_NEWICK_SPECIAL = re.compile(rb"[;\[\]'\"]")
+
+
+def newick_offsets(filename, chunk_size=1 << 20):
+    """
+    Yield (start, end) byte offsets of every tree in a Newick file.
+    Only semicolons outside of [comments] and quoted names end a tree. The
+    file is scanned in chunks, so memory use does not depend on its size.
+    :param filename:
+    :param chunk_size:
+    :return:
+    """
+    start = None
+    # Either None or the character that closes the current comment or quote
+    closing = None
+    position = 0
+    with open(filename, mode='rb') as infile:
+        while True:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+            if start is None:
+                stripped = chunk.lstrip()
+                if stripped:
+                    start = position + len(chunk) - len(stripped)
+            for match in _NEWICK_SPECIAL.finditer(chunk):
+                char = match.group()
+                if closing is not None:
+                    if char == closing:
+                        closing = None
+                elif char == b'[':
+                    closing = b']'
+                elif char in b'\'"':
+                    closing = char
+                elif char == b';':
+                    end = position + match.end()
+                    if start is not None and start < end:
+                        yield start, end
+                    # The next tree starts after the whitespace
+                    rest = chunk[match.end():]
+                    stripped = rest.lstrip()
+                    start = end + len(rest) - len(stripped) if stripped \
+                        else None
+            position += len(chunk)
+
+
+def read_newick_tree(filename, start, end):
+    """
+    Read a single tree from a Newick file given its byte offsets.
+    :param filename:
+    :param start:
+    :param end:
+    :return: a dendropy Tree
+    """
+    with open(filename, mode='rb') as infile:
+        infile.seek(start)
+        string = infile.read(end - start).decode(encoding='utf-8')
+    return Tree.get_from_string(string, schema='newick')
 
 
 # Operations on vectors
@@ -0,0 +1,48 @@
+#! /usr/bin/env python3.6
+
+from argparse import ArgumentParser
+from sys import stderr
+from time import time
+
+from vector_io import directory_vectors, vector_counts
+from vector_sets import LabelIndex
+
+
+parser = ArgumentParser("""Find the trees nearest to given ones.
+An index of vector directories is built first with `-d`, then the trees closest
+to the query vector files are looked up in it with `-q`""")
+parser.add_argument('-i', type=str, required=True,
+                    help='Index filename (.npz)')
+parser.add_argument('-d', type=str, nargs='*',
+                    help="""Vector directories to index, as in mds_vectors.py.
+                    The index is (re)built if any are given""")
+parser.add_argument('-q', type=str, nargs='*',
+                    help='Query vector files (*.vector or *.bvector)')
+parser.add_argument('-k', type=int, default=10,
+                    help='Number of nearest trees to return')
+parser.add_argument('-z', action='store_true',
+                    help='Process zero values. Only used when building')
+args = parser.parse_args()
+
+if args.d:
+    start = time()
+
+    def named_vectors():
+        for directory in args.d:
+            for name, counts in directory_vectors(directory):
+                yield name, counts
+
+    index = LabelIndex.build(named_vectors(), process_zeroes=args.z)
+    index.save(args.i)
+    print('Indexed {} trees in {} seconds'.format(len(index), time() - start),
+          file=stderr)
+elif args.q:
+    index = LabelIndex.load(args.i)
+if args.q:
+    for query in args.q:
+        start = time()
+        nearest = index.query(vector_counts(query), k=args.k)
+        print('Query {} took {} seconds'.format(query, time() - start),
+              file=stderr)
+        for name, distance in nearest:
+            print('{}\t{}\t{}'.format(query, name, distance))
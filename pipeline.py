@@ -0,0 +1,51 @@
+"""
+Scheduling of the worker pool of process_tree_set.py --pipeline.
+
+Trees are sent to the workers in batches sized from the time the trees took
+so far, and only a bounded number of batches are in flight, so the task queue
+of the pool never holds the whole tree set.
+"""
+
+
+def adaptive_batches(tasks, timing, target=0.5, limit=1024):
+    """
+    Group tasks into batches that take about `target` seconds each.
+    The batch size follows the average time per task so far, which the
+    consumer of the batches keeps in `timing`, so tiny trees are sent in big
+    batches and huge ones one by one. The first batch has a single task.
+    :param tasks: an iterable of tasks
+    :param timing: a dict with the 'seconds' taken by the 'tasks' processed
+    so far
+    :param target: seconds per batch
+    :param limit: the largest batch size
+    :return: a generator of lists of tasks
+    """
+    batch = []
+    for task in tasks:
+        batch.append(task)
+        if timing['tasks']:
+            size = target * timing['tasks'] / max(timing['seconds'], 1e-9)
+            size = int(max(1, min(size, limit)))
+        else:
+            size = 1
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bounded(iterable, slots):
+    """
+    Yield from an iterable, taking a slot of a semaphore for every item.
+    Pool.imap reads its tasks as fast as it can, so without this the whole
+    input could end up in the task queue. The consumer of the results frees a
+    slot for every result it takes, so no more items than the semaphore allows
+    are in flight.
+    :param iterable:
+    :param slots: a threading.BoundedSemaphore
+    :return:
+    """
+    for item in iterable:
+        slots.acquire()
+        yield item
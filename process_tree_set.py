@@ -1,67 +1,554 @@
 #! /usr/bin/env python3.6
 
 from argparse import ArgumentParser
-from multiprocessing import Pool
-from os import getpid, cpu_count
+from collections import defaultdict
+from json import dumps
+from multiprocessing import Manager, Pool
+from queue import Queue
+from threading import BoundedSemaphore, Thread
+from os import getpid, cpu_count, path
 from sys import stderr
 from time import time
 
 from dendropy import TreeList
 
-from metrics import annotate_rooted_tree, label_graph_annotation, leaf_enumeration_annotation
+from metrics import annotate_rooted_tree, leaf_enumeration_annotation, \
+    LabelTable, LABEL_HASHES, newick_offsets, read_newick_tree, LabelCache, \
+    get_label_cache, set_label_cache, topology_fingerprint, LabelProfiler, \
+    set_label_profiler, get_label_profiler, profiled_phase
+from vector_io import hashing_name, write_binary_vector, write_vector_file, \
+    PackedVectorWriter, VectorCache, SketchWriter, write_duplicates, \
+    parse_shard, shard_suffix, write_shard_manifest
+from pipeline import adaptive_batches, bounded
 
 
-def write_tree(tree, func, filename, hashing):
+def tree_vector(tree, func):
     """
-    Get a vector for a given tree and write it into a file.
+    Collect the labels of a tree annotated by a given function into a list
     :param tree:
+    :param func:
+    :return:
+    """
+    r = []
+    for node in tree.preorder_node_iter():
+        if func is not annotate_rooted_tree:
+            if not isinstance(node.annotations['CPM-labels'].value, int):
+                # The int thing is for skipping the root value
+                r += node.annotations['CPM-labels'].value.values()
+        else:
+            r.append(node.annotations['CP-label'].value)
+    return r
+
+
+def write_vector(filename, vector, func, hashing, label_table, file_format,
+                 tree_index):
+    """
+    Write a tree vector in the text or binary format. Packed vectors are
+    added to the packed file elsewhere
+    :param filename:
+    :param vector:
+    :param func: the labeling function
+    :param hashing:
+    :param label_table:
+    :param file_format: 'text', 'binary' or 'packed'
+    :param tree_index:
     :return:
     """
+    if file_format == 'text':
+        write_vector_file(filename, vector)
+    elif file_format == 'binary':
+        write_binary_vector(filename, vector,
+                            method=func is annotate_rooted_tree and 'rooted'
+                            or 'unrooted',
+                            hashing=hashing_name(hashing, label_table),
+                            tree_index=tree_index)
+
+
+def write_tree(tree, func, filename, hashing, label_table=None,
+               hash_threshold=None, file_format='text', tree_index=-1,
+               vector_cache=None, sketch_width=None, defer_write=False):
+    """
+    Get a vector for a given tree and write it into a file.
+    :param tree:
+    :param label_table: a shared LabelTable, if labels are to be interned
+    :param hash_threshold: maximum bit length of labels that are not hashed
+    :param file_format: 'text', 'binary' or 'packed'. Packed vectors are not
+    written, but returned to the main process, which has the packed file
+    :param tree_index: number of the tree in the tree file
+    :param vector_cache: a VectorCache to look the tree topology up in before
+    labeling it. Vectors computed on a miss are added to the cache
+    :param sketch_width: if set, the vector sketch of this width is returned
+    :param defer_write: if True, the vector is not written, but returned to
+    the main process, whatever the format
+    :return: a (tree_index, vector, sketch) tuple. Vector is None unless the
+    format is packed or defer_write is set, and sketch is None unless
+    sketch_width is set
+    """
     # Unpacking an argument tuple. Which is a tuple because of Pool.map()
     start = time()
-    func(tree, hashing=hashing)
-    with open(filename, mode='w') as outfile:
-        for node in tree.preorder_node_iter():
-            if func == label_graph_annotation:
-                if not isinstance(node.annotations['CPM-labels'].value, int):
-                    # The int thing is for skipping the root value
-                    for key in node.annotations['CPM-labels'].value:
-                        print(str(node.annotations['CPM-labels'].value[key]),
-                              file=outfile)
-            else:
-                print(str(node.annotations['CP-label'].value),
-                      file=outfile)
-    print('Processed vector {} in {} seconds by {}'.format(filename,
-                                                           str(time()-start),
-                                                           getpid()),
+    vector = None
+    if vector_cache is not None:
+        rooted = func is annotate_rooted_tree
+        key = vector_cache.key(topology_fingerprint(tree, rooted=rooted),
+                               '{} {} {}'.format(rooted and 'rooted'
+                                                 or 'unrooted',
+                                                 hashing_name(hashing),
+                                                 hash_threshold))
+        vector = vector_cache.get(key)
+    cached = vector is not None
+    if not cached:
+        with profiled_phase('label'):
+            func(tree, hashing=hashing, hash_threshold=hash_threshold,
+                 label_table=label_table)
+            vector = tree_vector(tree, func)
+        if vector_cache is not None:
+            vector_cache.put(key, vector)
+    if not defer_write:
+        with profiled_phase('write'):
+            write_vector(filename, vector, func, hashing, label_table,
+                         file_format, tree_index)
+    print('{} vector {} in {} seconds by {}'.format(cached and 'Cached'
+                                                    or 'Processed',
+                                                    filename,
+                                                    str(time()-start),
+                                                    getpid()),
           file=stderr)
-            
-            
+    cache = get_label_cache()
+    if cache is not None:
+        print('Label cache of {}: {hits} hits, {misses} misses, {size} '
+              'entries'.format(getpid(), **cache.stats()), file=stderr)
+    sketch = None
+    if sketch_width:
+        # Sketches are optional and need scipy, unlike the rest
+        from vector_sets import sketch_vector
+        with profiled_phase('sketch'):
+            sketch = sketch_vector(vector, sketch_width)
+    return (tree_index,
+            vector if file_format == 'packed' or defer_write else None,
+            sketch)
+
+
+def _write_tree(func_args):
+    """
+    Unpack an argument tuple for write_tree, for use with Pool.imap. The
+    tuple has no label table, which the worker has already. When streaming,
+    the first element is a (tree file, start, end) tuple instead of a tree,
+    and the tree is parsed here, in the worker process.
+    :param func_args:
+    :return: write_tree results with the profile of the tree appended, which
+    is None unless a LabelProfiler is active
+    """
+    profiler = get_label_profiler()
+    if profiler is not None:
+        profiler.clear()
+    start = time()
+    tree = func_args[0]
+    if isinstance(tree, tuple):
+        with profiled_phase('parse'):
+            tree = read_newick_tree(*tree)
+    # The label table is installed once per worker by _start_worker
+    result = write_tree(tree, *func_args[1:4], worker_label_table,
+                        *func_args[4:])
+    if profiler is None:
+        return result + (None,)
+    stats = profiler.stats()
+    stats['tree'] = result[0]
+    stats['seconds'] = time() - start
+    stats['process'] = getpid()
+    return result + (stats,)
+
+
+def _write_trees(batch):
+    """
+    Run _write_tree for a batch of argument tuples, for pipelined runs
+    :param batch: a list of _write_tree arguments
+    :return: a tuple of the list of _write_tree results and the seconds the
+    batch took
+    """
+    start = time()
+    results = [_write_tree(x) for x in batch]
+    return results, time() - start
+
+
+def _fingerprint_tree(task):
+    """
+    Return the topology fingerprint of a tree, for use with Pool.imap
+    :param task: a (tree index, tree, rooted) tuple. The tree may be a (tree
+    file, start, end) tuple, as in _write_tree
+    :return: a (tree index, fingerprint) tuple
+    """
+    tree_index, tree, rooted = task
+    if isinstance(tree, tuple):
+        tree = read_newick_tree(*tree)
+    return tree_index, topology_fingerprint(tree, rooted=rooted)
+
+
+# The shared LabelTable of a worker process, if labels are interned
+worker_label_table = None
+
+
+def _start_worker(cache_size, profile=False, label_table=None):
+    """
+    Pool initializer: set up a label cache, a profiler and a label table in a
+    worker process
+    :param cache_size: maximum number of cached labels, 0 for no cache
+    :param profile: if True, profile the processing of every tree
+    :param label_table: a shared LabelTable. It is passed once per worker,
+    rather than with every tree, so that its local copy of the pairs lasts
+    for all the trees of the worker
+    :return:
+    """
+    global worker_label_table
+    worker_label_table = label_table
+    if cache_size:
+        set_label_cache(LabelCache(cache_size))
+    if profile:
+        set_label_profiler(LabelProfiler())
+
+
+def add_profile(total, profile):
+    """
+    Add the profile of a tree to a total
+    :param total: a dict like LabelProfiler.stats() returns, updated in place
+    :param profile: a tree profile
+    :return:
+    """
+    for key in ('times', 'counts'):
+        for name, value in profile[key].items():
+            total[key][name] = total[key].get(name, 0) + value
+    for key in ('max_label_bits', 'peak_memory'):
+        if profile[key] is not None:
+            total[key] = max(total[key] or 0, profile[key])
+
+
 parser = ArgumentParser('Return CP- or CPM-vectors for a set of trees\n'+
                         'The vectors are written to a separate file each,\n'+
                         'named {tree_file}.tree_{tree_number}.vector')
 parser.add_argument('-t', type=str, help='Tree file in Newick format')
 parser.add_argument('-u', action='store_true',
                     help='Produce unrooted (CPM) labelling')
-parser.add_argument('--hash', action='store_true',
-                    help='Produce hashed labelling')
+parser.add_argument('--hash', nargs='?', const='md5', default=False,
+                    choices=sorted(LABEL_HASHES),
+                    help="""Produce hashed labelling. Optionally takes the hash
+                    to use, md5 (the default) or int64/int128 integer
+                    digests""")
+parser.add_argument('--hash-threshold', type=int, default=None,
+                    help="""Keep labels of up to this many bits exact and only
+                    hash the longer ones. Implies --hash int64 if --hash is not
+                    set""")
+parser.add_argument('--intern', type=str, default=None,
+                    help="""Label table file. If set, labels are replaced with
+                    collision-free IDs from this table, which is created if
+                    absent and updated with new labels after the run. Vectors
+                    are comparable between all runs that used the same table.
+                    """)
+parser.add_argument('--format', type=str, default='text',
+                    choices=('text', 'binary', 'packed'),
+                    help="""Vector file format. 'text' has a label per line,
+                    'binary' writes sorted labels with counts to
+                    {tree_file}_tree{tree_number}.bvector files, and 'packed'
+                    writes all binary vectors to a single {tree_file}.bvectors
+                    file. Packed vectors need --hash or --intern""")
+parser.add_argument('--stream', action='store_true',
+                    help="""Do not load the tree file in the main process. It
+                    only finds where each tree starts and ends, and workers
+                    parse the trees themselves, so memory use does not depend
+                    on the number of trees""")
+parser.add_argument('--sketch', type=int, default=0,
+                    help="""Also write sketches of this width, which give
+                    approximate distances, to {tree_file}.sketch.npy, a row
+                    per tree. See vector_sets.label_projection for accuracy.
+                    """)
+parser.add_argument('--dedup', action='store_true',
+                    help="""Label every topology once. Vectors are only
+                    written for the first tree of each topology, and the
+                    numbers of trees they stand for are written to
+                    {tree_file}.duplicates, which mds_vectors.py uses as
+                    weights""")
+parser.add_argument('--vector-cache', type=str, default=None,
+                    help="""Directory of cached vectors. Trees are looked up
+                    there by topology before labeling, and new vectors are
+                    added to it, so reruns and repeated topologies are not
+                    labeled again. Cannot be used with --intern""")
+parser.add_argument('--cache-size', type=int, default=0,
+                    help="""Keep up to this many labels and digests in a cache
+                    in every process, so that subtrees shared by several trees
+                    are labeled only once. Off by default""")
+parser.add_argument('--pipeline', action='store_true',
+                    help="""Run parsing (with --stream), labeling and writing
+                    as separate stages. Trees go to the workers in batches
+                    sized to take about half a second each, at most
+                    --queue-size batches are in flight, and the results are
+                    written by a separate thread while the workers go on.
+                    With --stream, memory stays bounded whatever the number
+                    of trees; without it, the whole tree file is loaded
+                    first""")
+parser.add_argument('--queue-size', type=int, default=0,
+                    help="""Number of batches in flight and of batches waiting
+                    to be written with --pipeline. Defaults to twice the
+                    number of processes""")
+parser.add_argument('--single-writer', action='store_true',
+                    help="""Write all the vector files from the main process
+                    instead of every worker writing its own, which is better
+                    on slow or network disks""")
+parser.add_argument('--shard', type=parse_shard, default=None,
+                    help="""Only process the i-th of n shards of the trees,
+                    given as i/n, counting from 0. Trees are assigned to
+                    shards by their numbers, or by topology with --dedup, so
+                    every shard is processed independently, eg on its own
+                    machine. Shard files get a .shard{i}of{n} suffix, and
+                    merge_shards.py assembles them""")
+parser.add_argument('--profile', type=str, default=None,
+                    help="""Write the time every tree took in each phase
+                    (parse, label, combine, hash, write, sketch), the
+                    numbers of labels and hashes asked for, --cache-size hits
+                    included, the longest label and the peak memory of the
+                    process to this file, a JSON
+                    line per tree. The last line sums them up for all trees
+                    and has the throughput. Profiling slows labeling down
+                    """)
 parser.add_argument('--processes', type=int, default=0,
                     help='Number of processes. Defaults to processor number')
 args = parser.parse_args()
+if args.hash_threshold is not None and not args.hash:
+    args.hash = 'int64'
+if args.format == 'packed' and not (args.hash or args.intern):
+    parser.error('Packed vectors need fixed width labels: use --hash or '
+                 '--intern')
+if args.shard and args.intern:
+    # Every shard would have its own table
+    parser.error('--shard cannot be used with --intern')
+if args.hash == 'md5' and args.hash_threshold is not None and \
+        args.format in ('binary', 'packed'):
+    # Short labels are kept exact, and records have a fixed width
+    parser.error('Binary vectors cannot mix MD5 and exact labels: use '
+                 '--hash-threshold with int64 or int128 hashing')
+if args.vector_cache and args.intern:
+    # Interned labels depend on the table, not only on the topology
+    parser.error('--vector-cache cannot be used with --intern')
 
 start = time()
 process_count = args.processes if args.processes else cpu_count()
 print('Using {} processes'.format(process_count), file=stderr)
-file_mask = args.t.split('.')[0]+'_tree{}.vector'
-trees = TreeList.get_from_path(args.t, schema='newick')
-print('Loaded {} trees'.format(len(trees)), file=stderr)
+file_mask = args.t.split('.')[0] + (args.format == 'binary' and
+                                    '_tree{}.bvector' or '_tree{}.vector')
+# Base name of the files for the whole tree set or the shard
+output_base = args.t.split('.')[0] + (args.shard and shard_suffix(args.shard)
+                                      or '')
+if args.stream:
+    # Only byte offsets are passed to the workers
+    trees = ((args.t, tree_start, tree_end)
+             for tree_start, tree_end in newick_offsets(args.t))
+else:
+    trees = TreeList.get_from_path(args.t, schema='newick')
+    print('Loaded {} trees'.format(len(trees)), file=stderr)
 counter = 0
 f = args.u and leaf_enumeration_annotation or annotate_rooted_tree
-func_args = [(trees[i], f, file_mask.format(str(i)), args.hash) for i in range(len(trees))]
-p = Pool(process_count)
-_ = p.starmap(write_tree, func_args, chunksize=1)
+label_table = None
+if args.intern:
+    manager = Manager()
+    label_table = LabelTable.shared(manager,
+                                    path.exists(args.intern) and
+                                    LabelTable.load(args.intern) or None)
+vector_cache = args.vector_cache and VectorCache(args.vector_cache) or None
+p = Pool(process_count, initializer=_start_worker,
+         initargs=(args.cache_size, bool(args.profile), label_table))
+# Tree numbers of every topology's first tree, with the numbers of the other
+# trees with the same topology
+copies = None
+if args.dedup:
+    # Fingerprinting is much cheaper than labeling, so all trees are
+    # fingerprinted first, and only the first tree of a topology is labeled
+    trees = list(trees)
+    first_trees = {}
+    copies = defaultdict(list)
+    for tree_index, fingerprint in p.imap(_fingerprint_tree,
+                                          ((i, tree, not args.u)
+                                           for i, tree in enumerate(trees)),
+                                          chunksize=16):
+        first_tree = first_trees.setdefault(fingerprint, tree_index)
+        if first_tree == tree_index:
+            copies[tree_index] = []
+        else:
+            copies[first_tree].append(tree_index)
+    print('Found {} topologies among {} trees'.format(len(copies),
+                                                      len(trees)),
+          file=stderr)
+    if args.shard:
+        # The topologies are split, so that every shard has all the trees
+        # of its topologies
+        shard, shard_count = args.shard
+        fingerprints = {first_tree: fingerprint
+                        for fingerprint, first_tree in first_trees.items()}
+        copies = {x: y for x, y in copies.items()
+                  if int(fingerprints[x], 16) % shard_count == shard}
+        print('Shard {} of {} has {} topologies'.format(shard, shard_count,
+                                                        len(copies)),
+              file=stderr)
+# Number of trees in the tree file, counted while they are read
+tree_count = 0
+
+
+def selected_trees():
+    """
+    Yield the (tree number, tree) pairs of the trees to process
+    :return:
+    """
+    global tree_count
+    for i, tree in enumerate(trees):
+        tree_count = i + 1
+        if copies is not None:
+            if i in copies:
+                yield i, tree
+        elif not args.shard or i % args.shard[1] == args.shard[0]:
+            yield i, tree
+
+
+func_args = ((tree, f, file_mask.format(str(i)), args.hash,
+              args.hash_threshold, args.format, i, vector_cache, args.sketch,
+              args.single_writer)
+             for i, tree in selected_trees())
+writer = None
+if args.format == 'packed':
+    packed_name = output_base + '.bvectors'
+    writer = PackedVectorWriter(packed_name,
+                                method=args.u and 'unrooted' or 'rooted',
+                                hashing=hashing_name(args.hash, label_table))
+profile_file = None
+if args.profile:
+    profile_file = open(args.profile, mode='w')
+    total_profile = {'times': {}, 'counts': {}, 'max_label_bits': 0,
+                     'peak_memory': None}
+    labeling_start = time()
+sketch_writer = None
+if args.sketch:
+    sketch_name = output_base + '.sketch.npy'
+    sketch_writer = SketchWriter(sketch_name, args.sketch)
+
+# The trees processed by this shard, mapped to the first tree of their
+# topology
+shard_trees = {} if args.shard else None
+
+
+def write_result(result):
+    """
+    Write everything the main process writes for a tree
+    :param result: a _write_tree result
+    :return:
+    """
+    global counter
+    tree_index, vector, sketch, profile = result
+    if shard_trees is not None:
+        shard_trees[tree_index] = tree_index
+        for copy in copies is not None and copies[tree_index] or ():
+            shard_trees[copy] = tree_index
+    if profile_file is not None:
+        print(dumps(profile, sort_keys=True), file=profile_file)
+        add_profile(total_profile, profile)
+    if args.single_writer:
+        write_vector(file_mask.format(str(tree_index)), vector, f, args.hash,
+                     label_table, args.format, tree_index)
+    if writer is not None:
+        writer.add(vector, tree_index)
+    if sketch_writer is not None:
+        sketch_writer.add(sketch, tree_index)
+        # Sketches are written for every tree
+        for copy in copies is not None and copies[tree_index] or ():
+            sketch_writer.add(sketch, copy)
+    counter += 1
+
+
+if args.pipeline:
+    queue_size = args.queue_size or 2 * process_count
+    slots = BoundedSemaphore(queue_size)
+    timing = {'seconds': 0.0, 'tasks': 0}
+    # Batches of results wait here for the writing thread. When it is full,
+    # results are not taken from the pool, and no more trees are sent
+    write_queue = Queue(queue_size)
+    write_errors = []
+
+    def write_batches():
+        """
+        Write batches of results until a None
+        :return:
+        """
+        while True:
+            batch = write_queue.get()
+            if batch is None:
+                return
+            if write_errors:
+                # Only draining the queue after a failure
+                continue
+            try:
+                for result in batch:
+                    write_result(result)
+            except Exception as error:
+                write_errors.append(error)
+
+    write_thread = Thread(target=write_batches)
+    write_thread.start()
+    try:
+        for batch, seconds in p.imap_unordered(
+                _write_trees, bounded(adaptive_batches(func_args, timing),
+                                      slots)):
+            slots.release()
+            timing['seconds'] += seconds
+            timing['tasks'] += len(batch)
+            write_queue.put(batch)
+            if write_errors:
+                break
+    finally:
+        write_queue.put(None)
+        write_thread.join()
+    if write_errors:
+        raise write_errors[0]
+else:
+    for result in p.imap_unordered(_write_tree, func_args):
+        write_result(result)
+if writer is not None:
+    writer.close()
+    print('Packed vectors written to {}'.format(packed_name), file=stderr)
+if sketch_writer is not None:
+    sketch_writer.close()
+    print('Sketches written to {}'.format(sketch_name), file=stderr)
+if profile_file is not None:
+    labeling_time = time() - labeling_start
+    total_profile.update({'summary': True, 'trees': counter,
+                          'seconds': labeling_time,
+                          'trees_per_second': counter / labeling_time,
+                          'processes': process_count})
+    print(dumps(total_profile, sort_keys=True), file=profile_file)
+    profile_file.close()
+    print('Processed {:.2f} trees per second, profile written to {}'.format(
+        counter / labeling_time, args.profile), file=stderr)
+if copies is not None:
+    duplicates_name = output_base + '.duplicates'
+    if args.format == 'packed':
+        names = {'{}#{}'.format(path.basename(packed_name), x): len(y) + 1
+                 for x, y in copies.items()}
+    else:
+        names = {path.basename(file_mask.format(str(x))): len(y) + 1
+                 for x, y in copies.items()}
+    write_duplicates(duplicates_name, names)
+    print('Tree counts written to {}'.format(duplicates_name), file=stderr)
+if shard_trees is not None:
+    manifest_name = output_base + '.manifest'
+    write_shard_manifest(manifest_name, args.shard,
+                         ' '.join(str(x) for x in (
+                             args.u and 'unrooted' or 'rooted',
+                             hashing_name(args.hash, label_table),
+                             args.hash_threshold, args.format, args.sketch,
+                             args.dedup and 'dedup' or 'all')),
+                         len(trees) if copies is not None else tree_count,
+                         shard_trees)
+    print('Shard manifest written to {}'.format(manifest_name), file=stderr)
+if label_table is not None:
+    label_table.save(args.intern)
+    print('Label table with {} entries written to {}'.format(len(label_table),
+                                                             args.intern),
+          file=stderr)
 print('Processed {} trees in {} seconds using {} processes'.format(
-                                                                str(len(trees)),
+                                                                str(counter),
                                                                 time()-start,
                                                                 process_count),
       file=stderr)
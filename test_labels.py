@@ -3,12 +3,16 @@ A pytest-compatible test suite for metrics.py
 """
 
 from gmpy2 import mpz
+from hashlib import md5
 
 import pytest
 from dendropy import Tree
 
 from metrics import label_parent, get_rooted_vector, get_root_label, \
-    get_unrooted_vector, vector_dict
+    get_unrooted_vector, vector_dict, ArrayTree, LabelTable, LABEL_HASHES, \
+    newick_offsets, read_newick_tree, LabelCache, set_label_cache, \
+    topology_fingerprint, LabeledTree, all_rootings, annotate_rooted_tree, \
+    LabelProfiler, set_label_profiler, profiled_phase
 
 
 @pytest.fixture
@@ -36,6 +40,35 @@ def test_rooted_labels(tree):
     assert get_root_label(tree) == 11
 
 
+def test_array_tree_from_newick():
+    array_tree = ArrayTree.from_newick(
+        "(('A,B'[comment]:1.0,B:2)n1:0.3,C);")
+    assert list(array_tree.parent) == [2, 2, 4, 4, -1]
+    assert list(array_tree.left) == [-1, -1, 0, -1, 2]
+    assert array_tree.leaf_count == 3
+    with pytest.raises(ValueError):
+        ArrayTree.from_newick('(A, B, C);')
+
+
+def test_array_rooted_labels(tree):
+    array_tree = ArrayTree.from_dendropy(tree)
+    assert get_rooted_vector(array_tree) == get_rooted_vector(tree)
+    assert get_root_label(array_tree) == 11
+    assert get_rooted_vector(array_tree, hashing=True) == \
+        get_rooted_vector(tree, backend='array', hashing=True)
+
+
+def test_array_unrooted_labels(tree):
+    array_tree = ArrayTree.from_newick(tree.as_string(schema='newick'))
+    assert get_unrooted_vector(array_tree) == \
+        get_unrooted_vector(tree, annotation_method='graph')
+    assert get_unrooted_vector(array_tree, hashing=True) == \
+        get_unrooted_vector(tree, hashing=True, backend='array')
+    assert vector_dict(get_unrooted_vector(array_tree, hashing=True)) == \
+        vector_dict(md5(str(x).encode(encoding='utf-8')).hexdigest()
+                    for x in get_unrooted_vector(array_tree))
+
+
 def test_wave_unrooted_labels(tree):
     assert get_unrooted_vector(tree, annotation_method='wave') ==\
                                         [mpz(x) for x in
@@ -56,6 +89,44 @@ def test_graph_unrooted_labels(tree):
              38, 38, 38, 38, 38, 38, 38, 38]]
     
     
+def test_twopass_unrooted_labels(tree):
+    assert get_unrooted_vector(tree, annotation_method='twopass') == \
+           [mpz(x) for x in
+            [1, 1, 1, 1, 1, 1, 1, 1,
+             2, 2, 2, 2,
+             4, 4,
+             9, 9, 9, 9,
+             38, 38, 38, 38, 38, 38, 38, 38]]
+
+
+def test_twopass_matches_graph():
+    newick = '((((A, B), C), (D, (E, F))), ((G, H), (I, (J, K))));'
+    vectors = [get_unrooted_vector(Tree.get_from_string(newick,
+                                                        schema='newick'),
+                                   hashing=True, annotation_method=method)
+               for method in ('twopass', 'graph')]
+    assert vector_dict(vectors[0]) == vector_dict(vectors[1])
+
+
+def test_interned_labels(tree, tmp_path):
+    table = LabelTable()
+    assert get_rooted_vector(tree, label_table=table) == \
+        [1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 4]
+    # The same subtrees get the same IDs in other trees and methods
+    other = Tree.get_from_string('((A, B), ((C, D), (E, F)));',
+                                 schema='newick')
+    assert get_root_label(other, label_table=table) == 5
+    assert len(table) == 4
+    methods = ('graph', 'wave', 'twopass')
+    vectors = [get_unrooted_vector(Tree.get_from_string(
+        '(((A, B), (C, D)), ((E, F), (G, H)));', schema='newick'),
+        annotation_method=method, label_table=table) for method in methods]
+    assert vectors[0] == vectors[1] == vectors[2]
+    table.save(str(tmp_path / 'table.txt'))
+    loaded = LabelTable.load(str(tmp_path / 'table.txt'))
+    assert loaded.mapping == table.mapping
+
+
 def test_rooted_hashed_labels(tree):
     assert vector_dict(get_rooted_vector(tree, hashing=True)) ==\
        vector_dict(['c4ca4238a0b923820dcc509a6f75849b',
@@ -125,3 +196,196 @@ def test_leaf_unrooted_hashed_labels(tree):
         'a5771bce93e200c36f7cd9dfd0e5deaa', 'a5771bce93e200c36f7cd9dfd0e5deaa',
         'a5771bce93e200c36f7cd9dfd0e5deaa', 'a5771bce93e200c36f7cd9dfd0e5deaa',
         'a5771bce93e200c36f7cd9dfd0e5deaa'])
+
+
+@pytest.mark.parametrize('hashing', ['int64', 'int128'])
+def test_integer_hashed_labels(tree, hashing):
+    digest = LABEL_HASHES[hashing]
+    assert digest(mpz(11)) == digest(11)
+    assert digest(1).bit_length() <= int(hashing[3:])
+    expected = vector_dict(digest(x) for x in
+                           [1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 4, 4,
+                            9, 9, 9, 9, 38, 38, 38, 38, 38, 38, 38, 38])
+    for method in ('graph', 'wave', 'leaf', 'twopass'):
+        vector = get_unrooted_vector(
+            Tree.get_from_string('(((A, B), (C, D)), ((E, F), (G, H)));',
+                                 schema='newick'),
+            hashing=hashing, annotation_method=method)
+        assert vector_dict(vector) == expected
+    assert get_root_label(tree, hashing=hashing) == digest(11)
+
+
+def test_adaptive_hashed_labels():
+    newick = '((((A, B), C), (D, (E, F))), ((G, H), (I, (J, K))));'
+    exact = get_unrooted_vector(Tree.get_from_string(newick, schema='newick'),
+                                annotation_method='twopass')
+    for method in ('graph', 'wave', 'leaf', 'twopass'):
+        vector = get_unrooted_vector(
+            Tree.get_from_string(newick, schema='newick'), hashing='int64',
+            hash_threshold=8, annotation_method=method)
+        assert [x for x in vector if x < 256] == \
+            [x for x in exact if x < 256]
+        assert all(x >= 2 ** 63 for x in vector if x >= 256)
+        assert len(vector) == len(exact)
+    mixed = get_rooted_vector(Tree.get_from_string(newick, schema='newick'),
+                              hashing=True, hash_threshold=4)
+    assert mixed[:11] == [1] * 11
+    assert isinstance(mixed[-1], str)
+    with pytest.raises(ValueError):
+        get_rooted_vector(Tree.get_from_string(newick, schema='newick'),
+                          hashing='int64', hash_threshold=64)
+
+
+def test_leaf_enumeration_deep_tree():
+    # A caterpillar much deeper than the recursion limit. The labels grow too
+    # quickly to be kept exact, so they are interned
+    caterpillar = Tree()
+    node = caterpillar.seed_node
+    for _ in range(2999):
+        node.new_child()
+        node = node.new_child()
+    table = LabelTable()
+    vector = get_unrooted_vector(caterpillar, annotation_method='leaf',
+                                 label_table=table)
+    assert len(vector) == 2 * (2 * 3000 - 3)
+    assert vector == get_unrooted_vector(caterpillar, backend='array',
+                                         label_table=table)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1 << 20])
+def test_newick_offsets(tmp_path, chunk_size):
+    # Semicolons in comments and quoted names do not end a tree
+    trees = ['((A, B), C);', "(('x;y', B)[&note=a;b], C);", '(A, (B, C));']
+    filename = str(tmp_path / 'trees.nwk')
+    with open(filename, mode='w') as outfile:
+        outfile.write('\n' + '\n\n'.join(trees) + '\n')
+    offsets = list(newick_offsets(filename, chunk_size=chunk_size))
+    assert len(offsets) == 3
+    with open(filename, mode='rb') as infile:
+        data = infile.read()
+    assert [data[start:end].decode() for start, end in offsets] == trees
+    assert sorted(get_rooted_vector(read_newick_tree(filename,
+                                                     *offsets[2]))) == \
+        [1, 1, 1, 2, 3]
+
+
+@pytest.mark.parametrize('hashing', [False, True, 'int64'])
+def test_label_cache(hashing):
+    newick = '(((A, B), (C, D)), ((E, F), (G, (H, I))));'
+    expected = [get_unrooted_vector(Tree.get_from_string(newick,
+                                                         schema='newick'),
+                                    hashing=hashing, annotation_method=method)
+                for method in ('graph', 'leaf')]
+    cache = LabelCache(maxsize=4)
+    previous = set_label_cache(cache)
+    try:
+        for _ in range(2):
+            assert [get_unrooted_vector(
+                Tree.get_from_string(newick, schema='newick'),
+                hashing=hashing, annotation_method=method)
+                for method in ('graph', 'leaf')] == expected
+    finally:
+        set_label_cache(previous)
+    stats = cache.stats()
+    assert stats['hits'] > 0 and stats['misses'] > 0
+    assert stats['evictions'] > 0
+    assert len(cache) == 4
+    assert 0 < stats['hit_rate'] < 1
+
+
+def test_label_profiler():
+    tree = Tree.get_from_string('(((A, B), (C, D)), ((E, F), (G, H)));',
+                                schema='newick')
+    profiler = LabelProfiler()
+    previous = set_label_profiler(profiler)
+    try:
+        with profiled_phase('label'):
+            annotate_rooted_tree(tree, hashing='int64')
+    finally:
+        set_label_profiler(previous)
+    stats = profiler.stats()
+    # 7 internal nodes, every node hashed
+    assert stats['counts'] == {'labels': 7, 'hashes': 15}
+    # The root label is 11
+    assert stats['max_label_bits'] == 4
+    assert set(stats['times']) == {'label', 'combine', 'hash'}
+    assert stats['times']['label'] >= stats['times']['combine']
+    profiler.clear()
+    assert profiler.stats()['counts'] == {}
+    # Cache hits are counted as labels and hashes alike
+    previous_cache = set_label_cache(LabelCache())
+    set_label_profiler(profiler)
+    try:
+        for _ in range(2):
+            annotate_rooted_tree(tree, hashing='int64')
+    finally:
+        set_label_profiler(previous)
+        set_label_cache(previous_cache)
+    assert profiler.stats()['counts'] == {'labels': 14, 'hashes': 30}
+
+
+def test_topology_fingerprint():
+    def fingerprint(newick, rooted):
+        return topology_fingerprint(Tree.get_from_string(newick,
+                                                         schema='newick'),
+                                    rooted=rooted)
+    # The same unrooted tree rooted in two places, and a different one
+    first = '(((A, B), C), (D, (E, F)));'
+    second = '((A, B), (C, (D, (E, F))));'
+    other = '(((A, B), (C, D)), (E, F));'
+    assert fingerprint(first, True) != fingerprint(second, True)
+    assert fingerprint(first, False) == fingerprint(second, False)
+    assert fingerprint(first, False) != fingerprint(other, False)
+    # Names and children order do not matter
+    assert fingerprint('(((X, Y), (Z, W)), (V, U));', False) == \
+        fingerprint(other, False)
+    assert fingerprint('((E, F), ((C, D), (A, B)));', True) == \
+        fingerprint(other, True)
+    assert topology_fingerprint(ArrayTree.from_newick(first)) == \
+        fingerprint(first, True)
+
+
+@pytest.mark.parametrize('unrooted', [False, True])
+@pytest.mark.parametrize('hashing', [False, 'int64'])
+def test_labeled_tree_moves(unrooted, hashing):
+    tree = LabeledTree(ArrayTree.from_newick(
+        '((((A, B), C), (D, E)), ((F, G), (H, (I, J))));'),
+        unrooted=unrooted, hashing=hashing)
+    vector_function = unrooted and get_unrooted_vector or get_rooted_vector
+    counts = tree.counts()
+    # Node numbers are postorder ones: 0 is A, 2 is (A, B), 4 is ((A, B), C)
+    # and 18 is the root
+    moves = [(tree.spr, (0, 13)), (tree.nni, (4,)), (tree.spr, (9, 0)),
+             (tree.spr, (17, 1)), (tree.nni, (2,)), (tree.spr, (6, 12))]
+    for move, move_args in moves:
+        delta = move(*move_args)
+        assert all(delta.values())
+        for label, change in delta.items():
+            counts[label] = counts.get(label, 0) + change
+        counts = {label: count for label, count in counts.items() if count}
+        assert counts == vector_dict(vector_function(tree.array_tree(),
+                                                     hashing=hashing,
+                                                     backend='array'))
+        assert counts == tree.counts()
+    with pytest.raises(ValueError):
+        tree.spr(tree.root, 0)
+    with pytest.raises(ValueError):
+        tree.spr(tree.parent[0], 0)
+
+
+@pytest.mark.parametrize('hashing', [False, True])
+def test_all_rootings(hashing):
+    newick = '(((A, B), C), ((D, E), (F, (G, H))));'
+    original = Tree.get_from_string(newick, schema='newick')
+    rootings = list(all_rootings(original, hashing=hashing))
+    assert len(rootings) == 2 * 8 - 3
+    for node, root_label, vector in rootings:
+        tree = Tree.get_from_string(newick, schema='newick')
+        target = list(tree.postorder_node_iter())[node]
+        if target.parent_node is not tree.seed_node:
+            tree.reroot_at_edge(target.edge, suppress_unifurcations=True)
+        assert vector == get_rooted_vector(tree, hashing=hashing)
+        assert root_label == get_root_label(tree, hashing=hashing)
+    assert [x[1] for x in all_rootings(original, hashing=hashing,
+                                       vectors=False)] == \
+        [x[1] for x in rootings]
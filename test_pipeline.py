@@ -0,0 +1,36 @@
+"""
+A pytest-compatible test suite for pipeline.py
+"""
+
+from threading import BoundedSemaphore
+
+from pipeline import adaptive_batches, bounded
+
+
+def test_adaptive_batches():
+    timing = {'seconds': 0.0, 'tasks': 0}
+    batches = []
+    for batch in adaptive_batches(range(20), timing, target=1, limit=8):
+        batches.append(batch)
+        # Every task takes 0.25 seconds, so 4 of them make a batch
+        timing['seconds'] += 0.25 * len(batch)
+        timing['tasks'] += len(batch)
+        if len(batches) == 3:
+            # Now tasks take no time, and batches hit the limit
+            timing['seconds'] = 0.0
+    assert [len(x) for x in batches] == [1, 4, 4, 8, 3]
+    assert sum(batches, []) == list(range(20))
+    assert list(adaptive_batches([], timing)) == []
+
+
+def test_bounded():
+    slots = BoundedSemaphore(2)
+    items = bounded(range(5), slots)
+    assert [next(items), next(items)] == [0, 1]
+    # Both slots are taken until a consumer frees one
+    assert not slots.acquire(blocking=False)
+    slots.release()
+    assert next(items) == 2
+    for _ in range(2):
+        slots.release()
+    assert list(items) == [3, 4]
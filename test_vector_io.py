@@ -0,0 +1,112 @@
+"""
+A pytest-compatible test suite for vector_io.py
+"""
+
+import numpy as np
+import pytest
+
+from metrics import vector_dict
+from vector_io import write_binary_vector, read_binary_vector, \
+    record_counts, vector_counts, PackedVectorWriter, PackedVectors, \
+    directory_vectors, write_vector_file, VectorCache, SketchWriter, \
+    write_duplicates, directory_duplicates, parse_shard, \
+    write_shard_manifest, read_shard_manifest, merge_shard_manifests
+
+
+def test_binary_vector(tmp_path):
+    filename = str(tmp_path / 'tree3.bvector')
+    vector = [1, 1, 1, 1, 1, 1, 2, 2, 300, 4, 2]
+    write_binary_vector(filename, vector, method='unrooted', tree_index=3)
+    header, records = read_binary_vector(filename)
+    assert header['method'] == 'unrooted'
+    assert header['tree_index'] == 3
+    assert header['width'] == 2
+    # Records are sorted by label
+    assert list(records['count']) == [6, 3, 1, 1]
+    assert record_counts(records, header['hashing']) == vector_dict(vector)
+    assert vector_counts(filename) == vector_dict(vector)
+
+
+def test_binary_md5_vector(tmp_path):
+    filename = str(tmp_path / 'tree.bvector')
+    vector = ['c4ca4238a0b923820dcc509a6f75849b',
+              'c4ca4238a0b923820dcc509a6f75849b',
+              'c81e728d9d4c2f636f067f89cc14862c']
+    write_binary_vector(filename, vector, hashing='md5')
+    assert vector_counts(filename) == vector_dict(vector)
+    with pytest.raises(ValueError):
+        write_binary_vector(filename, vector + [1], hashing='md5')
+
+
+def test_packed_vectors(tmp_path):
+    filename = str(tmp_path / 'trees.bvectors')
+    vectors = {5: [1, 1, 2], 0: [1, 1, 1, 2, 2 ** 63 + 7], 2: []}
+    with PackedVectorWriter(filename, method='rooted',
+                            hashing='int64') as writer:
+        for tree_index, vector in vectors.items():
+            writer.add(vector, tree_index)
+    packed = PackedVectors(filename)
+    assert len(packed) == 3
+    assert list(packed.tree_indices) == [5, 0, 2]
+    for position, tree_index in enumerate(packed.tree_indices):
+        assert packed[position] == vector_dict(vectors[tree_index])
+    write_vector_file(str(tmp_path / 'other.vector'), [1, 2, 2])
+    names = [name for name, _ in directory_vectors(str(tmp_path))]
+    assert names == [str(tmp_path / 'other.vector'), filename + '#5',
+                     filename + '#0', filename + '#2']
+
+
+def test_vector_cache(tmp_path):
+    cache = VectorCache(str(tmp_path / 'cache'))
+    key = cache.key('0123abcd', 'rooted md5 None')
+    assert key != cache.key('0123abcd', 'unrooted md5 None')
+    assert cache.get(key) is None
+    cache.put(key, [1, 1, 1, 2, 3])
+    assert cache.get(key) == ['1', '1', '1', '2', '3']
+    assert VectorCache(str(tmp_path / 'cache')).get(key) == \
+        ['1', '1', '1', '2', '3']
+
+
+def test_sketch_writer(tmp_path):
+    filename = str(tmp_path / 'trees.sketch.npy')
+    with SketchWriter(filename, 3) as writer:
+        writer.add([2, 2, 2], 2)
+        writer.add([0.5, 0, 1], 0)
+        with pytest.raises(ValueError):
+            writer.add([1, 1], 1)
+        writer.add([3, 3, 3], 3)
+    assert np.array_equal(np.load(filename),
+                          [[0.5, 0, 1], [0, 0, 0], [2, 2, 2], [3, 3, 3]])
+
+
+def test_duplicates(tmp_path):
+    write_duplicates(str(tmp_path / 'a.duplicates'),
+                     {'a_tree0.vector': 3, 'a_tree1.vector': 1})
+    write_duplicates(str(tmp_path / 'b.duplicates'), {'b.bvectors#2': 2})
+    assert directory_duplicates(str(tmp_path)) == {'a_tree0.vector': 3,
+                                                   'b.bvectors#2': 2}
+
+
+def test_shard_manifests(tmp_path):
+    assert parse_shard('1/3') == (1, 3)
+    for value in ('3/3', '-1/2', '1', 'a/b'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+    # Trees 2 and 3 have the topology of tree 0
+    shards = [{0: 0, 2: 0, 3: 0}, {1: 1, 4: 4}]
+    manifests = []
+    for shard, trees in enumerate(shards):
+        filename = str(tmp_path / 'shard{}'.format(shard))
+        write_shard_manifest(filename, (shard, 2), 'rooted md5', 5, trees)
+        manifests.append(read_shard_manifest(filename))
+    assert manifests[1] == {'shard': (1, 2), 'settings': 'rooted md5',
+                            'tree_count': 5, 'trees': {1: 1, 4: 4}}
+    assert merge_shard_manifests(manifests) == {0: 0, 1: 1, 2: 0, 3: 0, 4: 4}
+    with pytest.raises(ValueError):
+        merge_shard_manifests(manifests[:1])
+    missing = dict(manifests[1], trees={1: 1})
+    with pytest.raises(ValueError):
+        merge_shard_manifests([manifests[0], missing])
+    other = dict(manifests[1], settings='rooted int64')
+    with pytest.raises(ValueError):
+        merge_shard_manifests([manifests[0], other])
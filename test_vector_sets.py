@@ -0,0 +1,271 @@
+"""
+A pytest-compatible test suite for vector_sets.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+from dendropy import TreeList
+from scipy.sparse import csr_matrix
+
+from metrics import euclidean, get_rooted_vector, get_unrooted_vector, \
+    vector_dict, ArrayTree, LabelTable
+from vector_io import read_vector_file
+from vector_sets import count_matrix, DistanceEngine, batch_rooted_labels, \
+    read_matrix_index, write_matrix_index, LabelIndex, SketchEngine, \
+    label_projection, sketch_matrix, sketch_vector, sketch_width, \
+    classical_mds, landmark_mds, choose_landmarks, unique_rows, \
+    merge_distance_shards
+
+
+@pytest.fixture
+def trees():
+    return TreeList.get_from_path('data/test_trees.nwk', schema='newick')
+
+
+def test_count_matrix(trees):
+    vocabulary, matrix = count_matrix(trees)
+    assert matrix.shape == (4, len(vocabulary))
+    # The first tree is ((A, B), (C, D)): four leaves, two cherries and a root
+    assert matrix[0, vocabulary[1]] == 4
+    assert matrix[0, vocabulary[2]] == 2
+    assert matrix[0, vocabulary[4]] == 1
+    assert matrix.sum() == sum(2 * len(tree.leaf_nodes()) - 1
+                               for tree in trees)
+
+
+def test_count_matrix_unrooted(trees):
+    expected = [vector_dict(get_unrooted_vector(tree, hashing='int64',
+                                                backend='array'))
+                for tree in trees]
+    vocabulary, matrix = count_matrix(
+        (tree for tree in trees), vector_function=get_unrooted_vector,
+        annotation_method='twopass', hashing='int64')
+    for row, counts in enumerate(expected):
+        assert {label: matrix[row, column]
+                for label, column in vocabulary.items()
+                if matrix[row, column]} == dict(counts)
+
+
+def test_count_matrix_from_files(tmp_path):
+    filenames = []
+    for index, labels in enumerate((['1', '1', '2'],
+                                    ['1', '1', '1', '2', '5'])):
+        filename = str(tmp_path / 'tree{}.vector'.format(index))
+        with open(filename, mode='w') as outfile:
+            print('\n'.join(labels), file=outfile)
+        filenames.append(filename)
+    assert read_vector_file(filenames[0]) == ['1', '1', '2']
+    vocabulary, matrix = count_matrix(filenames)
+    assert vocabulary == {'1': 0, '2': 1, '5': 2}
+    assert matrix.toarray().tolist() == [[2, 1, 0], [3, 1, 1]]
+
+
+@pytest.mark.parametrize('process_zeroes', [True, False])
+def test_distance_engine(process_zeroes):
+    vectors = [[1, 1, 2], [1, 1, 1, 2, 5], [3, 4, 4], [1, 2, 2, 4], [7], [1]]
+    _, matrix = count_matrix(vectors)
+    engine = DistanceEngine(matrix, process_zeroes=process_zeroes)
+    distances = engine.distance_matrix(batch_size=4, dtype=np.float64)
+    for row, first in enumerate(vectors):
+        for column, second in enumerate(vectors):
+            assert distances[row, column] == pytest.approx(
+                euclidean(vector_dict(first), vector_dict(second),
+                          process_zeroes))
+
+
+def test_distance_file(tmp_path):
+    vectors = [[1, 1, 2], [1, 1, 1, 2, 5], [3, 4, 4], [1, 2, 2, 4], [7], [1]]
+    _, matrix = count_matrix(vectors)
+    filename = str(tmp_path / 'distances.npy')
+    expected = DistanceEngine(matrix).distance_matrix(batch_size=2)
+
+    class Interrupted(Exception):
+        pass
+
+    class FailingEngine(DistanceEngine):
+        # Fails after computing a given number of tiles
+        def __init__(self, matrix, tiles):
+            super().__init__(matrix)
+            self.left = tiles
+
+        def block(self, rows, columns):
+            if not self.left:
+                raise Interrupted
+            self.left -= 1
+            return super().block(rows, columns)
+
+    with pytest.raises(Interrupted):
+        FailingEngine(matrix, 2).distance_file(filename, batch_size=2)
+    # Only the four remaining tiles of six are computed on resume
+    engine = FailingEngine(matrix, 4)
+    distances = engine.distance_file(filename, batch_size=2)
+    assert engine.left == 0
+    assert np.array_equal(distances, expected)
+    assert np.array_equal(np.load(filename), expected)
+    assert not os.path.exists(filename + '.progress')
+    # Different settings start over
+    distances = DistanceEngine(matrix).distance_file(filename, batch_size=4)
+    assert np.array_equal(distances, expected)
+    # So do different vectors of the same number
+    with pytest.raises(Interrupted):
+        FailingEngine(matrix, 2).distance_file(filename, batch_size=2)
+    _, other = count_matrix(vectors[::-1])
+    engine = FailingEngine(other, 6)
+    distances = engine.distance_file(filename, batch_size=2)
+    assert engine.left == 0
+    assert np.array_equal(distances,
+                          DistanceEngine(other).distance_matrix())
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 16])
+def test_update_distance_file(tmp_path, batch_size):
+    vectors = [[1, 1, 2], [1, 1, 1, 2, 5], [3, 4, 4], [1, 2, 2, 4], [7], [1]]
+    filename = str(tmp_path / 'distances.npy')
+    # Vectors 0, 2 and 4 were there before, in a different order, along with
+    # one that was removed since
+    _, matrix = count_matrix([vectors[4], vectors[0], [9, 9], vectors[2]])
+    DistanceEngine(matrix).distance_file(filename)
+    _, matrix = count_matrix(vectors)
+    engine = DistanceEngine(matrix)
+    distances = engine.update_distance_file(filename, filename,
+                                            {0: 4, 1: 0, 3: 2},
+                                            batch_size=batch_size)
+    assert np.allclose(distances, engine.distance_matrix())
+    assert distances.shape == (6, 6)
+
+
+def test_distance_shards(tmp_path):
+    counts = np.random.default_rng(4).integers(0, 3, size=(23, 9))
+    engine = DistanceEngine(counts)
+    names = [str(tmp_path / 'm.shard{}of3.npy'.format(x)) for x in range(3)]
+    # 6 tiles of 8 rows
+    assert [engine.distance_shard(x, (i, 3), batch_size=8)
+            for i, x in enumerate(names)] == [2, 2, 2]
+    with pytest.raises(ValueError):
+        merge_distance_shards(str(tmp_path / 'm.npy'), names[:2])
+    matrix, process_zeroes = merge_distance_shards(str(tmp_path / 'm.npy'),
+                                                   names)
+    assert process_zeroes
+    assert np.allclose(matrix, engine.distance_matrix(), atol=1e-5)
+    # Other vectors
+    DistanceEngine(counts[::-1]).distance_shard(names[2], (2, 3),
+                                                batch_size=8)
+    with pytest.raises(ValueError):
+        merge_distance_shards(str(tmp_path / 'm.npy'), names)
+    # Other settings
+    engine.distance_shard(names[2], (2, 3), batch_size=4)
+    with pytest.raises(ValueError):
+        merge_distance_shards(str(tmp_path / 'm.npy'), names)
+
+
+def test_matrix_index(tmp_path):
+    filename = str(tmp_path / 'distances.npy.index')
+    write_matrix_index(filename, ['a/tree0.vector', 'b.bvectors#3'], True)
+    assert read_matrix_index(filename) == (['a/tree0.vector', 'b.bvectors#3'],
+                                           True)
+
+
+def test_batch_rooted_labels(trees):
+    batch = list(trees) + [ArrayTree.from_newick('(A, (B, (C, (D, E))));'),
+                           ArrayTree.from_newick('A;')]
+    table = LabelTable()
+    matrix = batch_rooted_labels(batch, table)
+    assert matrix.shape == (len(batch), 11)
+    size = len(table)
+    for row, tree in zip(matrix, batch):
+        assert sorted(row[row > 0]) == \
+            sorted(get_rooted_vector(tree, label_table=table))
+    # Every pair was already in the table
+    assert len(table) == size
+    assert batch_rooted_labels([], table).shape == (0, 0)
+
+
+@pytest.mark.parametrize('process_zeroes', [True, False])
+def test_label_index(tmp_path, process_zeroes):
+    vectors = [[1, 1, 2], [1, 1, 1, 2, 5], [3, 4, 4], [1, 2, 2, 4], [7], [1],
+               [1, 1, 2]]
+    names = ['tree{}'.format(x) for x in range(len(vectors))]
+    index = LabelIndex.build(zip(names, vectors),
+                             process_zeroes=process_zeroes)
+    filename = str(tmp_path / 'index')
+    index.save(filename)
+    index = LabelIndex.load(filename)
+    assert len(index) == len(vectors)
+    for query in vectors + [[1, 1, 9], [8, 8]]:
+        distances = sorted((euclidean(vector_dict(query), vector_dict(x),
+                                      process_zeroes), position)
+                           for position, x in enumerate(vectors))
+        nearest = index.query(query, k=3)
+        assert [x[0] for x in nearest] == \
+            [names[position] for _, position in distances[:3]]
+        assert [x[1] for x in nearest] == \
+            pytest.approx([x for x, _ in distances[:3]])
+    # Text vector labels are strings, but match the same labels from trees
+    assert index.query({'2': 1, '1': 2}, k=3) == index.query([1, 2, 1], k=3)
+
+
+def test_sketches():
+    vectors = [[1, 1, 2], [1, 1, 1, 2, 5], [3, 4, 4], [1, 2, 2, 4], [7], [1]]
+    vocabulary, matrix = count_matrix(vectors)
+    sketches = sketch_matrix(matrix, vocabulary, 512)
+    assert sketches.shape == (6, 512)
+    # Rows depend on the label only, and not on its type
+    assert np.allclose(sketch_vector([str(x) for x in vectors[1]], 512),
+                       sketches[1])
+    assert not np.allclose(label_projection([1], 512),
+                           label_projection([1], 512, seed=1))
+    exact = DistanceEngine(matrix).distance_matrix(dtype=np.float64)
+    approximate = SketchEngine(sketches).distance_matrix(dtype=np.float64)
+    assert np.allclose(np.diag(approximate), 0, atol=1e-6)
+    # The relative standard deviation of squared distances is 1/16 here, so
+    # this fails with a negligible probability for a random seed, and never
+    # for a fixed one
+    rows, columns = np.triu_indices(6, 1)
+    ratios = approximate[rows, columns] ** 2 / exact[rows, columns] ** 2
+    assert np.all(np.abs(ratios - 1) < 0.4)
+    assert sketch_width(1000, 0.5) < sketch_width(1000, 0.2) < \
+        sketch_width(10 ** 6, 0.2)
+
+
+def _pairwise(points):
+    return np.sqrt(((points[:, None] - points[None]) ** 2).sum(axis=2))
+
+
+@pytest.mark.parametrize('size', [3, 40])
+def test_classical_mds(size):
+    # Planar points are embedded exactly, up to a rotation
+    points = np.random.default_rng(1).normal(size=(size, 2)) * [3, 1]
+    distances = _pairwise(points)
+    coords = classical_mds(distances, dimensions=2, batch_size=7)
+    assert coords.shape == (size, 2)
+    assert np.allclose(_pairwise(coords), distances)
+
+
+def test_weighted_classical_mds():
+    # Weights stand for copies of the points
+    points = np.random.default_rng(3).normal(size=(12, 2)) * [3, 1]
+    weights = np.arange(1, 13)
+    expanded = np.repeat(points, weights, axis=0)
+    coords = classical_mds(_pairwise(points), batch_size=5, weights=weights)
+    assert np.allclose(_pairwise(np.repeat(coords, weights, axis=0)),
+                       _pairwise(expanded))
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_unique_rows(sparse):
+    matrix = np.array([[0, 2, 1], [1, 0, 0], [0, 2, 1], [0, 0, 0], [1, 0, 0]])
+    first, inverse = unique_rows(csr_matrix(matrix) if sparse else matrix)
+    assert list(first) == [0, 1, 3]
+    assert list(inverse) == [0, 1, 0, 2, 1]
+
+
+def test_landmark_mds():
+    points = np.random.default_rng(2).normal(size=(60, 2)) * [3, 1]
+    engine = SketchEngine(points)
+    landmarks, distances = choose_landmarks(engine, 5, batch_size=16)
+    assert len(set(landmarks)) == 5
+    assert np.allclose(distances, _pairwise(points)[:, landmarks])
+    coords = landmark_mds(engine, landmarks=5, batch_size=16)
+    assert np.allclose(_pairwise(coords), _pairwise(points))
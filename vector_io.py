@@ -0,0 +1,635 @@
+"""
+Reading and writing vector files.
+
+Besides the text format produced by process_tree_set.py (one label per line),
+there is a binary one that can be read with numpy.memmap. A binary file starts
+with a fixed-size header, followed by the records: a fixed-width big-endian
+label and its count, sorted by label. A packed file keeps the vectors for a
+whole tree set one after another, with an index of tree numbers and record
+offsets at the end of the file.
+
+Sketches of a tree set (see vector_sets.label_projection) are stored as a
+single .npy float32 matrix with a row per tree.
+
+VectorCache keeps text vectors on disk, addressed by tree topology and
+labeling settings, so they are not recomputed for the topologies seen before.
+
+A tree set may be processed in shards, on several machines; every shard lists
+the trees it processed in a manifest, and merge_shards.py checks those lists
+before assembling the shards.
+"""
+
+from glob import glob
+from hashlib import blake2b
+from os import getpid, makedirs, path, remove, replace
+from struct import Struct
+
+import numpy as np
+
+from metrics import vector_dict
+
+# Magic, version, method, hashing, label width, tree index, record count,
+# index offset. Tree index is -1 and the index offset is set in packed files
+HEADER = Struct('<4sHHHHqQQ4x')
+SINGLE_MAGIC = b'CPVB'
+PACKED_MAGIC = b'CPVP'
+VERSION = 1
+METHODS = ('rooted', 'unrooted')
+HASHINGS = ('none', 'md5', 'int64', 'int128', 'intern')
+# Label widths that are known in advance, in bytes
+HASHING_WIDTHS = {'md5': 16, 'int64': 8, 'int128': 16, 'intern': 8}
+
+
+def read_vector_file(filename):
+    """
+    Return a list of labels from a vector file, one label per line.
+    Labels are returned as strings, as in process_tree_set.py output.
+    :param filename:
+    :return:
+    """
+    with open(filename) as infile:
+        return [line.rstrip() for line in infile if line.strip()]
+
+
+def write_vector_file(filename, vector):
+    """
+    Write a vector as a text file, one label per line.
+    :param filename:
+    :param vector:
+    :return:
+    """
+    with open(filename, mode='w') as outfile:
+        for label in vector:
+            print(str(label), file=outfile)
+
+
+def hashing_name(hashing, label_table=None):
+    """
+    Return the name a `hashing` kwarg value is recorded under in the header
+    :param hashing:
+    :param label_table: a LabelTable if labels were interned
+    :return:
+    """
+    if label_table is not None and not hashing:
+        return 'intern'
+    if hashing is True:
+        return 'md5'
+    if not hashing:
+        return 'none'
+    if hashing not in HASHINGS:
+        raise ValueError('Unknown label hash {}'.format(hashing))
+    return hashing
+
+
+def record_dtype(width):
+    """
+    Return the numpy dtype of a record with labels of a given width
+    :param width:
+    :return:
+    """
+    return np.dtype([('label', 'V{}'.format(width)), ('count', '<u4')])
+
+
+def _encode_label(label, width, hashing):
+    """
+    Return a label as big-endian bytes of a given width
+    :param label:
+    :param width:
+    :param hashing:
+    :return:
+    """
+    if hashing == 'md5':
+        if not isinstance(label, str):
+            raise ValueError('Binary vectors cannot mix MD5 and exact labels')
+        return bytes.fromhex(label)
+    return int(label).to_bytes(width, 'big')
+
+
+def decode_label(raw, hashing):
+    """
+    Return a label from its record bytes. MD5 labels are returned as hex
+    strings, all the others as ints.
+    :param raw:
+    :param hashing:
+    :return:
+    """
+    if hashing == 'md5':
+        return bytes(raw).hex()
+    return int.from_bytes(bytes(raw), 'big')
+
+
+def _label_width(labels, hashing):
+    """
+    Return the record label width for a collection of labels
+    :param labels:
+    :param hashing:
+    :return:
+    """
+    if hashing in HASHING_WIDTHS:
+        return HASHING_WIDTHS[hashing]
+    return max([(int(x).bit_length() + 7) // 8 for x in labels] + [1])
+
+
+def _records(vector, width, hashing):
+    """
+    Return a sorted record array for a vector
+    :param vector:
+    :param width:
+    :param hashing:
+    :return:
+    """
+    counts = sorted((_encode_label(label, width, hashing), count)
+                    for label, count in vector_dict(vector).items())
+    records = np.zeros(len(counts), dtype=record_dtype(width))
+    for index, (raw, count) in enumerate(counts):
+        records[index] = (raw, count)
+    return records
+
+
+def write_binary_vector(filename, vector, method='rooted', hashing='none',
+                        tree_index=-1):
+    """
+    Write a vector to a binary file.
+    :param filename:
+    :param vector: a list of labels
+    :param method: 'rooted' or 'unrooted'
+    :param hashing: one of HASHINGS, see hashing_name
+    :param tree_index: number of the tree in its tree set
+    :return:
+    """
+    width = _label_width(vector, hashing)
+    records = _records(vector, width, hashing)
+    with open(filename, mode='wb') as outfile:
+        outfile.write(HEADER.pack(SINGLE_MAGIC, VERSION, METHODS.index(method),
+                                  HASHINGS.index(hashing), width, tree_index,
+                                  len(records), 0))
+        outfile.write(records.tobytes())
+
+
+def _read_header(filename, magic):
+    """
+    Return the header of a binary vector file as a dict
+    :param filename:
+    :param magic:
+    :return:
+    """
+    with open(filename, mode='rb') as infile:
+        raw = infile.read(HEADER.size)
+    if len(raw) < HEADER.size or raw[:4] != magic:
+        raise ValueError('{} is not a binary vector file'.format(filename))
+    _, version, method, hashing, width, tree_index, count, index_offset = \
+        HEADER.unpack(raw)
+    if version != VERSION:
+        raise ValueError('Unsupported vector file version {}'.format(version))
+    return {'method': METHODS[method], 'hashing': HASHINGS[hashing],
+            'width': width, 'tree_index': tree_index, 'count': count,
+            'index_offset': index_offset}
+
+
+def read_binary_vector(filename):
+    """
+    Open a binary vector file.
+    :param filename:
+    :return: a tuple of the header dict and a read-only memmap of the records
+    """
+    header = _read_header(filename, SINGLE_MAGIC)
+    if not header['count']:
+        return header, np.zeros(0, dtype=record_dtype(header['width']))
+    records = np.memmap(filename, dtype=record_dtype(header['width']),
+                        mode='r', offset=HEADER.size, shape=(header['count'],))
+    return header, records
+
+
+def record_counts(records, hashing):
+    """
+    Return a {label: count} dict for a record array
+    :param records:
+    :param hashing:
+    :return:
+    """
+    return {decode_label(raw, hashing): int(count)
+            for raw, count in zip(records['label'], records['count'])}
+
+
+class PackedVectorWriter:
+    """
+    Writes the vectors of a whole tree set to a single packed file.
+    Vectors can be added in any order; each is stored with its tree number.
+    The file is only valid after `close`, which writes the index.
+    """
+    def __init__(self, filename, method='rooted', hashing='none', width=None):
+        if width is None:
+            if hashing not in HASHING_WIDTHS:
+                raise ValueError('Label width is needed for exact labels')
+            width = HASHING_WIDTHS[hashing]
+        self.filename = filename
+        self.method = method
+        self.hashing = hashing
+        self.width = width
+        self.tree_indices = []
+        self.offsets = [0]
+        self.file = open(filename, mode='wb')
+        self.file.write(bytes(HEADER.size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.tree_indices)
+
+    def add(self, vector, tree_index):
+        """
+        Append a vector for a tree
+        :param vector: a list of labels
+        :param tree_index:
+        :return:
+        """
+        if self.hashing not in HASHING_WIDTHS and \
+                _label_width(vector, self.hashing) > self.width:
+            raise ValueError('Labels of tree {} do not fit in {} bytes'.format(
+                tree_index, self.width))
+        records = _records(vector, self.width, self.hashing)
+        self.file.write(records.tobytes())
+        self.tree_indices.append(tree_index)
+        self.offsets.append(self.offsets[-1] + len(records))
+
+    def add_records(self, records, tree_index):
+        """
+        Append the records of a tree as they are, eg from another packed file
+        with the same labels
+        :param records: a record array with labels of this writer's width
+        :param tree_index:
+        :return:
+        """
+        if records.dtype != record_dtype(self.width):
+            raise ValueError('Records of tree {} are not {} bytes '
+                             'wide'.format(tree_index, self.width))
+        self.file.write(records.tobytes())
+        self.tree_indices.append(tree_index)
+        self.offsets.append(self.offsets[-1] + len(records))
+
+    def close(self):
+        """
+        Write the index and the header
+        :return:
+        """
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(np.asarray(self.tree_indices, dtype='<i8').tobytes())
+        self.file.write(np.asarray(self.offsets, dtype='<u8').tobytes())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(PACKED_MAGIC, VERSION,
+                                    METHODS.index(self.method),
+                                    HASHINGS.index(self.hashing), self.width,
+                                    -1, len(self.tree_indices), index_offset))
+        self.file.close()
+
+
+class PackedVectors:
+    """
+    Read-only access to a packed vector file.
+    Records are memory-mapped, so opening the file reads only the index.
+    Iterating over it yields a {label: count} dict for every tree, in the
+    order they were written.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = _read_header(filename, PACKED_MAGIC)
+        self.hashing = self.header['hashing']
+        size = self.header['count']
+        index = np.fromfile(filename, dtype='<i8', count=2 * size + 1,
+                            offset=self.header['index_offset'])
+        self.tree_indices = index[:size]
+        self.offsets = index[size:].astype(np.uint64)
+        total = int(self.offsets[-1])
+        if total:
+            self.records = np.memmap(filename,
+                                     dtype=record_dtype(self.header['width']),
+                                     mode='r', offset=HEADER.size,
+                                     shape=(total,))
+        else:
+            self.records = np.zeros(0,
+                                    dtype=record_dtype(self.header['width']))
+
+    def __len__(self):
+        return len(self.tree_indices)
+
+    def records_for(self, position):
+        """
+        Return the records of the tree stored at a given position
+        :param position:
+        :return:
+        """
+        return self.records[int(self.offsets[position]):
+                            int(self.offsets[position + 1])]
+
+    def __getitem__(self, position):
+        return record_counts(self.records_for(position), self.hashing)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+
+class SketchWriter:
+    """
+    Writes the sketches of a tree set to a single .npy file, a row per tree in
+    the order of tree numbers. Sketches can be added in any order: they are
+    kept in a temporary file until `close`, which sorts them, so memory use
+    does not depend on the number of trees. Rows of the missing tree numbers
+    are zero.
+    """
+    def __init__(self, filename, width):
+        self.filename = filename
+        self.width = width
+        self.tree_indices = []
+        self.temporary = filename + '.tmp'
+        self.file = open(self.temporary, mode='wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.tree_indices)
+
+    def add(self, sketch, tree_index):
+        """
+        Append a sketch for a tree
+        :param sketch: an array of `width` numbers
+        :param tree_index:
+        :return:
+        """
+        sketch = np.asarray(sketch, dtype='<f4')
+        if sketch.shape != (self.width,):
+            raise ValueError('Sketch of tree {} is not {} wide'.format(
+                tree_index, self.width))
+        self.file.write(sketch.tobytes())
+        self.tree_indices.append(tree_index)
+
+    def close(self):
+        """
+        Write the sorted sketches to the .npy file
+        :return:
+        """
+        if self.file.closed:
+            return
+        self.file.close()
+        count = len(self.tree_indices)
+        result = np.lib.format.open_memmap(
+            self.filename, mode='w+', dtype='<f4',
+            shape=(count and max(self.tree_indices) + 1, self.width))
+        if count:
+            rows = np.memmap(self.temporary, dtype='<f4', mode='r',
+                             shape=(count, self.width))
+            indices = np.asarray(self.tree_indices, dtype=np.int64)
+            for start in range(0, count, SKETCH_CHUNK):
+                part = slice(start, start + SKETCH_CHUNK)
+                result[indices[part]] = rows[part]
+            del rows
+        result.flush()
+        del result
+        remove(self.temporary)
+
+
+# Number of sketches SketchWriter sorts at once
+SKETCH_CHUNK = 1 << 16
+
+
+def vector_counts(filename):
+    """
+    Return a {label: count} dict for a single text or binary vector file
+    :param filename:
+    :return:
+    """
+    if filename.endswith('.bvector'):
+        header, records = read_binary_vector(filename)
+        return record_counts(records, header['hashing'])
+    return vector_dict(read_vector_file(filename))
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as 'i/n', the i-th of n shards, counting from zero
+    :param value:
+    :return: an (i, n) tuple
+    """
+    try:
+        shard, count = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise ValueError('Shard should be given as i/n, not {}'.format(value))
+    if not 0 <= shard < count:
+        raise ValueError('Shard {} is not between 0 and {}'.format(
+            shard, count - 1))
+    return shard, count
+
+
+def shard_suffix(shard):
+    """
+    Return the part of the names of a shard's output files that tells it
+    from the other shards
+    :param shard: an (i, n) tuple
+    :return:
+    """
+    return '.shard{}of{}'.format(*shard)
+
+
+def write_shard_manifest(filename, shard, settings, tree_count, trees):
+    """
+    Write the list of the trees a shard of process_tree_set.py processed,
+    which merge_shards.py checks the shards against
+    :param filename:
+    :param shard: an (i, n) tuple
+    :param settings: a string of the settings that all the shards should
+    share, without tabs
+    :param tree_count: number of trees in the whole tree file
+    :param trees: a {tree number: tree number} dict of the trees of the
+    shard. Trees are mapped to the first tree of their topology with
+    --dedup, which only has its vector written, and to themselves otherwise
+    :return:
+    """
+    with open(filename, mode='w') as outfile:
+        print('#shard\t{}\t{}'.format(*shard), file=outfile)
+        print('#settings\t{}'.format(settings), file=outfile)
+        print('#trees\t{}'.format(tree_count), file=outfile)
+        for tree in sorted(trees):
+            print('{}\t{}'.format(tree, trees[tree]), file=outfile)
+
+
+def read_shard_manifest(filename):
+    """
+    Read a shard manifest written by write_shard_manifest
+    :param filename:
+    :return: a dict with the 'shard', 'settings', 'tree_count' and 'trees'
+    as they were written
+    """
+    manifest = {'trees': {}}
+    with open(filename) as infile:
+        for line in infile:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '#shard':
+                manifest['shard'] = int(fields[1]), int(fields[2])
+            elif fields[0] == '#settings':
+                manifest['settings'] = fields[1]
+            elif fields[0] == '#trees':
+                manifest['tree_count'] = int(fields[1])
+            elif fields[0]:
+                manifest['trees'][int(fields[0])] = int(fields[1])
+    if set(manifest) != {'shard', 'settings', 'tree_count', 'trees'}:
+        raise ValueError('{} is not a shard manifest'.format(filename))
+    return manifest
+
+
+def merge_shard_manifests(manifests):
+    """
+    Check that shard manifests are all the shards of a single run, and that
+    every tree was processed by exactly one of them
+    :param manifests: a list of read_shard_manifest results
+    :return: a {tree number: first tree of its topology} dict for all trees
+    """
+    if not manifests:
+        raise ValueError('No shards to merge')
+    first = manifests[0]
+    count = first['shard'][1]
+    for manifest in manifests:
+        for key in ('settings', 'tree_count'):
+            if manifest[key] != first[key]:
+                raise ValueError('Shards {} and {} have different {}'.format(
+                    first['shard'], manifest['shard'], key))
+    shards = sorted(x['shard'] for x in manifests)
+    if shards != [(x, count) for x in range(count)]:
+        raise ValueError('Expected shards 0 to {} of {}, got {}'.format(
+            count - 1, count, shards))
+    trees = {}
+    for manifest in manifests:
+        overlap = trees.keys() & manifest['trees'].keys()
+        if overlap:
+            raise ValueError('Tree {} is in several shards'.format(
+                min(overlap)))
+        trees.update(manifest['trees'])
+    extra = trees.keys() - set(range(first['tree_count']))
+    if extra:
+        raise ValueError('Tree {} is not in the tree file of {} '
+                         'trees'.format(min(extra), first['tree_count']))
+    missing = set(range(first['tree_count'])) - trees.keys()
+    if missing:
+        raise ValueError('{} trees are in no shard, the first is {}'.format(
+            len(missing), min(missing)))
+    return trees
+
+
+def write_duplicates(filename, counts):
+    """
+    Write how many trees every vector stands for, as written by
+    process_tree_set.py --dedup. Vectors of a single tree are left out.
+    :param filename:
+    :param counts: a {vector name: number of trees} dict. Names are vector
+    file names without directories, or {packed file name}#{tree number}
+    :return:
+    """
+    with open(filename, mode='w') as outfile:
+        for name, count in counts.items():
+            if count > 1:
+                print('{}\t{}'.format(name, count), file=outfile)
+
+
+def directory_duplicates(directory):
+    """
+    Return the numbers of trees vectors stand for from all *.duplicates files
+    in a directory
+    :param directory:
+    :return: a {vector name: number of trees} dict, see write_duplicates
+    """
+    counts = {}
+    for filename in sorted(glob(path.join(directory, '*.duplicates'))):
+        with open(filename) as infile:
+            for line in infile:
+                if line.strip():
+                    name, count = line.rstrip('\n').split('\t')
+                    counts[name] = int(count)
+    return counts
+
+
+def directory_vectors(directory):
+    """
+    Yield a (name, {label: count}) tuple for every vector in a directory.
+    Text (*.vector) and binary (*.bvector) files are named by their paths,
+    and the trees from packed (*.bvectors) files as {path}#{tree number}.
+    :param directory:
+    :return:
+    """
+    for filename in sorted(glob(path.join(directory, '*.vector')) +
+                           glob(path.join(directory, '*.bvector'))):
+        yield filename, vector_counts(filename)
+    for filename in sorted(glob(path.join(directory, '*.bvectors'))):
+        packed = PackedVectors(filename)
+        for position, counts in enumerate(packed):
+            yield '{}#{}'.format(filename,
+                                 packed.tree_indices[position]), counts
+
+
+class VectorCache:
+    """
+    An on-disk cache of vectors, addressed by tree topology and labeling
+    settings.
+
+    A vector is stored as a text vector file named by a hash of the topology
+    fingerprint (see metrics.topology_fingerprint) and a settings string, eg
+    'unrooted md5 None', so the same directory can hold vectors made with
+    different settings. Files are written under a temporary name and renamed,
+    so several processes can share a cache. Cached labels are read back as
+    strings, like any other text vector.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(fingerprint, settings):
+        """
+        Return the cache key for a topology and labeling settings
+        :param fingerprint: a topology fingerprint
+        :param settings: a string describing everything else the vector depends
+        on
+        :return:
+        """
+        return blake2b('{}\t{}'.format(fingerprint, settings).encode(),
+                       digest_size=20).hexdigest()
+
+    def path(self, key):
+        """
+        Return the vector file name for a key
+        :param key:
+        :return:
+        """
+        return path.join(self.directory, key[:2], key + '.vector')
+
+    def get(self, key):
+        """
+        Return a cached vector or None if there is none
+        :param key:
+        :return:
+        """
+        try:
+            return read_vector_file(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, vector):
+        """
+        Store a vector
+        :param key:
+        :param vector:
+        :return:
+        """
+        filename = self.path(key)
+        makedirs(path.dirname(filename), exist_ok=True)
+        temporary = '{}.{}.tmp'.format(filename, getpid())
+        write_vector_file(temporary, vector)
+        replace(temporary, filename)
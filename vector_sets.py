@@ -0,0 +1,946 @@
+"""
+Operations on whole collections of tree vectors.
+Depends on numpy and scipy in addition to what metrics.py needs.
+"""
+
+from array import array
+from hashlib import blake2b
+from math import ceil, log, sqrt
+from os import path, remove, replace
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, issparse
+from scipy.sparse.linalg import eigsh, LinearOperator
+
+from metrics import get_rooted_vector, vector_dict, ArrayTree
+from vector_io import vector_counts
+
+
+def _source_counts(source, vector_function, kwargs):
+    """
+    Return a {label: count} dict for any kind of source count_matrix accepts
+    :param source:
+    :param vector_function:
+    :param kwargs:
+    :return:
+    """
+    if isinstance(source, str):
+        return vector_counts(source)
+    if isinstance(source, dict):
+        return source
+    if isinstance(source, (list, tuple)):
+        return vector_dict(source)
+    return vector_dict(vector_function(source, **kwargs))
+
+
+def count_matrix(sources, vocabulary=None, vector_function=get_rooted_vector,
+                 **kwargs):
+    """
+    Build a label count matrix for a collection of trees in a single pass.
+
+    Every row is a tree and every column is a distinct label; columns are
+    numbered in the order the labels are first met. Sources are consumed one
+    at a time, so a generator of trees or filenames is never held in memory.
+    Labels read from text vector files are strings and labels produced from
+    trees or binary files are numbers, so these kinds of sources should not be
+    mixed.
+    :param sources: an iterable of trees (dendropy Trees or ArrayTrees), text
+    or binary vector file names, label vectors or {label: count} dicts (eg the
+    trees of a PackedVectors)
+    :param vocabulary: a {label: column} dict to extend. A new one is created
+    if not supplied
+    :param vector_function: a function that returns a vector for a tree, eg
+    get_rooted_vector or get_unrooted_vector
+    :param kwargs: passed to `vector_function`, eg hashing='int64'
+    :return: a tuple of the vocabulary and a scipy.sparse CSR matrix
+    """
+    if vocabulary is None:
+        vocabulary = {}
+    indptr = array('q', [0])
+    indices = array('q')
+    counts = array('q')
+    for source in sources:
+        for label, count in _source_counts(source, vector_function,
+                                           kwargs).items():
+            column = vocabulary.get(label)
+            if column is None:
+                column = len(vocabulary)
+                vocabulary[label] = column
+            indices.append(column)
+            counts.append(count)
+        indptr.append(len(indices))
+    matrix = csr_matrix((np.asarray(counts, dtype=np.int64),
+                         np.asarray(indices, dtype=np.int64),
+                         np.asarray(indptr, dtype=np.int64)),
+                        shape=(len(indptr) - 1, len(vocabulary)))
+    matrix.sort_indices()
+    return vocabulary, matrix
+
+
+class DistanceEngine:
+    """
+    Euclidean distances between the rows of a label count matrix.
+
+    Distances are computed for whole blocks of rows at once with sparse
+    products, using |a - b|^2 = |a|^2 + |b|^2 - 2ab. Counts are integers, so
+    everything up to the square root is exact. With `process_zeroes` off, only
+    the labels present in both trees count, as in `metrics.euclidean`; then the
+    squares are summed over the labels of one tree that are present in another,
+    ie the squared counts are multiplied by the other tree's label indicators.
+    """
+    def __init__(self, matrix, process_zeroes=True):
+        self.matrix = csr_matrix(matrix, dtype=np.int64)
+        self.process_zeroes = process_zeroes
+        squares = self.matrix.multiply(self.matrix).tocsr()
+        if process_zeroes:
+            self.norms = np.asarray(squares.sum(axis=1)).ravel()
+        else:
+            self.squares = squares
+            self.present = self.matrix.sign()
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def digest(self):
+        """
+        Return a hex digest of the matrix, which tells the distance files of
+        this engine from those computed for other vectors
+        :return:
+        """
+        digest = blake2b(digest_size=16)
+        digest.update(repr(self.matrix.shape).encode())
+        if issparse(self.matrix):
+            self.matrix.sum_duplicates()
+            parts = (self.matrix.indptr, self.matrix.indices,
+                     self.matrix.data)
+        else:
+            parts = (self.matrix,)
+        for part in parts:
+            digest.update(np.ascontiguousarray(part).tobytes())
+        return digest.hexdigest()
+
+    def block(self, rows, columns):
+        """
+        Return distances between two sets of rows as a dense array
+        :param rows: a slice or an array of row indices
+        :param columns: a slice or an array of row indices
+        :return: an array of shape (len(rows), len(columns))
+        """
+        a, b = self.matrix[rows], self.matrix[columns]
+        squared = -2 * (a @ b.T).toarray()
+        if self.process_zeroes:
+            squared += self.norms[rows][:, None]
+            squared += self.norms[columns][None, :]
+        else:
+            squared += (self.squares[rows] @ self.present[columns].T).toarray()
+            squared += (self.present[rows] @ self.squares[columns].T).toarray()
+        return np.sqrt(squared)
+
+    def tiles(self, batch_size=1024):
+        """
+        Yield (rows, columns) slices of the tiles on and above the diagonal of
+        the distance matrix, row by row
+        :param batch_size: number of rows in a tile
+        :return:
+        """
+        return _tiles(len(self), batch_size)
+
+    def distance_matrix(self, batch_size=1024, dtype=np.float32):
+        """
+        Return a full square matrix of distances between all rows.
+        Only the blocks on and above the diagonal are computed.
+        :param batch_size: number of rows in a block
+        :param dtype:
+        :return:
+        """
+        size = len(self)
+        result = np.zeros((size, size), dtype=dtype)
+        for rows, columns in self.tiles(batch_size):
+            block = self.block(rows, columns)
+            result[rows, columns] = block
+            result[columns, rows] = block.T
+        return result
+
+    def distance_file(self, filename, batch_size=1024, dtype=np.float32):
+        """
+        Write a full square matrix of distances to a .npy file, tile by tile.
+
+        The matrix is never held in memory, so it can be larger than RAM. The
+        number of finished tiles is kept in `{filename}.progress`, along with
+        the settings and a digest of the count matrix; if the computation is
+        interrupted, calling this again with the same vectors and arguments
+        continues from the first unfinished tile. The progress file is removed
+        when the matrix is complete.
+        :param filename:
+        :param batch_size: number of rows in a tile
+        :param dtype:
+        :return: a read-only memmap of the matrix
+        """
+        size = len(self)
+        settings = '{}\t{}\t{}\t{}\t{}'.format(
+            size, batch_size, np.dtype(dtype).str, int(self.process_zeroes),
+            self.digest())
+        done = _read_progress(filename, settings)
+        if done:
+            result = np.lib.format.open_memmap(filename, mode='r+')
+        else:
+            result = np.lib.format.open_memmap(filename, mode='w+',
+                                               dtype=dtype, shape=(size, size))
+        for tile, (rows, columns) in enumerate(self.tiles(batch_size)):
+            if tile < done:
+                continue
+            block = self.block(rows, columns)
+            result[rows, columns] = block
+            result[columns, rows] = block.T
+            # The tile has to be on disk before it is marked as finished
+            result.flush()
+            _write_progress(filename, settings, tile + 1)
+        del result
+        if path.exists(filename + '.progress'):
+            remove(filename + '.progress')
+        return np.load(filename, mmap_mode='r')
+
+    def distance_shard(self, filename, shard, batch_size=1024,
+                       dtype=np.float32):
+        """
+        Compute the tiles of one of several shards of the distance matrix, eg
+        on its own machine. Tile k of `tiles` goes to shard k mod n. The
+        tiles are written one after another to a flat .npy file, and resumed
+        as in `distance_file`, but the progress file is kept for
+        `merge_distance_shards`, which checks the shards and assembles the
+        matrix.
+        :param filename: the .npy file of the shard
+        :param shard: an (i, n) tuple, see vector_io.parse_shard
+        :param batch_size: number of rows in a tile
+        :param dtype:
+        :return: the number of tiles of the shard
+        """
+        shard_index, count = shard
+        tiles = [x for k, x in enumerate(self.tiles(batch_size))
+                 if k % count == shard_index]
+        length = sum(_tile_area(x) for x in tiles)
+        settings = '{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(
+            len(self), batch_size, np.dtype(dtype).str,
+            int(self.process_zeroes), self.digest(), shard_index, count)
+        done = _read_progress(filename, settings)
+        if done:
+            result = np.lib.format.open_memmap(filename, mode='r+')
+        elif length:
+            result = np.lib.format.open_memmap(filename, mode='w+',
+                                               dtype=dtype, shape=(length,))
+        else:
+            # Memory maps cannot be empty
+            np.save(filename, np.zeros(0, dtype=dtype))
+        offset = 0
+        for tile, (rows, columns) in enumerate(tiles):
+            end = offset + _tile_area((rows, columns))
+            if tile >= done:
+                result[offset:end] = self.block(rows, columns).ravel()
+                result.flush()
+                _write_progress(filename, settings, tile + 1)
+            offset = end
+        if not tiles:
+            _write_progress(filename, settings, 0)
+        return len(tiles)
+
+    def update_distance_file(self, filename, previous, reused, batch_size=1024,
+                             dtype=np.float32):
+        """
+        Write a full square matrix of distances to a .npy file, reusing the
+        distances between the rows that were in a previous matrix.
+
+        Only the distances that involve the other rows are computed, so adding
+        M rows to N known ones takes O(NM + M^2) work instead of O((N+M)^2).
+        Previous rows missing from `reused` are dropped. The matrix is written
+        to a temporary file first, so `filename` may be `previous`.
+        :param filename:
+        :param previous: the .npy file with the previous matrix
+        :param reused: a {previous matrix row: row} dict
+        :param batch_size: number of rows in a tile
+        :param dtype:
+        :return: a read-only memmap of the matrix
+        """
+        size = len(self)
+        old = np.load(previous, mmap_mode='r')
+        temporary = filename + '.tmp.npy'
+        result = np.lib.format.open_memmap(temporary, mode='w+', dtype=dtype,
+                                           shape=(size, size))
+        old_rows = np.array(sorted(reused), dtype=np.int64)
+        rows = np.array([reused[x] for x in old_rows], dtype=np.int64)
+        for start in range(0, len(rows), batch_size):
+            part = slice(start, start + batch_size)
+            result[rows[part][:, None], rows] = \
+                old[old_rows[part]][:, old_rows]
+        added = np.setdiff1d(np.arange(size), rows)
+        old_batches = [rows[x:x + batch_size]
+                       for x in range(0, len(rows), batch_size)]
+        new_batches = [added[x:x + batch_size]
+                       for x in range(0, len(added), batch_size)]
+        for index, new_rows in enumerate(new_batches):
+            for columns in old_batches + new_batches[index:]:
+                block = self.block(new_rows, columns)
+                result[new_rows[:, None], columns] = block
+                result[columns[:, None], new_rows] = block.T
+        result.flush()
+        del result, old
+        replace(temporary, filename)
+        if path.exists(filename + '.progress'):
+            # It describes a matrix that is not there anymore
+            remove(filename + '.progress')
+        return np.load(filename, mmap_mode='r')
+
+
+def _tiles(size, batch_size):
+    """
+    Yield (rows, columns) slices of the tiles on and above the diagonal of a
+    square matrix, row by row
+    :param size: number of rows
+    :param batch_size: number of rows in a tile
+    :return:
+    """
+    for start in range(0, size, batch_size):
+        rows = slice(start, min(start + batch_size, size))
+        for column_start in range(start, size, batch_size):
+            yield rows, slice(column_start,
+                              min(column_start + batch_size, size))
+
+
+def _tile_area(tile):
+    """
+    Return the number of distances in a tile
+    :param tile: a (rows, columns) tuple of slices
+    :return:
+    """
+    rows, columns = tile
+    return (rows.stop - rows.start) * (columns.stop - columns.start)
+
+
+def _read_progress(filename, settings):
+    """
+    Return the number of finished tiles of a matrix file, if it exists and
+    was computed with the same settings, or 0
+    :param filename:
+    :param settings: a tab-separated string of settings
+    :return:
+    """
+    progress_name = filename + '.progress'
+    if not (path.exists(filename) and path.exists(progress_name)):
+        return 0
+    with open(progress_name) as progress_file:
+        saved_settings, _, saved_done = \
+            progress_file.read().strip().rpartition('\t')
+    return saved_settings == settings and int(saved_done) or 0
+
+
+def _write_progress(filename, settings, done):
+    """
+    Record the number of finished tiles of a matrix file
+    :param filename:
+    :param settings: a tab-separated string of settings
+    :param done:
+    :return:
+    """
+    progress_name = filename + '.progress'
+    with open(progress_name + '.tmp', mode='w') as progress_file:
+        print('{}\t{}'.format(settings, done), file=progress_file)
+    replace(progress_name + '.tmp', progress_name)
+
+
+def merge_distance_shards(filename, shard_filenames):
+    """
+    Assemble the full distance matrix from the files of all its shards, see
+    DistanceEngine.distance_shard. The shards are checked to be complete and
+    computed with the same settings first.
+    :param filename: the .npy file of the matrix
+    :param shard_filenames: the .npy files of the shards
+    :return: a tuple of a read-only memmap of the matrix and whether zeroes
+    were processed
+    """
+    shards = {}
+    settings = None
+    for name in shard_filenames:
+        if not path.exists(name + '.progress'):
+            raise ValueError('{} has no progress file'.format(name))
+        with open(name + '.progress') as progress_file:
+            fields = progress_file.read().strip().split('\t')
+        if len(fields) != 8:
+            raise ValueError('{} is not a distance matrix shard'.format(name))
+        # All shards should be computed from the same vectors
+        if settings is None:
+            settings = fields[:5] + fields[6:7]
+        elif fields[:5] + fields[6:7] != settings:
+            raise ValueError('{} was computed with different settings than '
+                             '{}'.format(name, shard_filenames[0]))
+        shards[int(fields[5])] = name, int(fields[7])
+    if settings is None:
+        raise ValueError('No shards to merge')
+    size, tile_size, dtype, process_zeroes, _, count = settings
+    size, tile_size, count = int(size), int(tile_size), int(count)
+    if sorted(shards) != list(range(count)):
+        raise ValueError('Expected shards 0 to {} of {}, got {}'.format(
+            count - 1, count, sorted(shards)))
+    tiles = list(_tiles(size, tile_size))
+    for shard, (name, done) in shards.items():
+        expected = len(range(shard, len(tiles), count))
+        if done != expected:
+            raise ValueError('Shard {} has {} of its {} tiles done'.format(
+                name, done, expected))
+    data = {x: np.load(y, mmap_mode='r') for x, (y, _) in shards.items()}
+    offsets = dict.fromkeys(data, 0)
+    result = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                       shape=(size, size))
+    for tile, (rows, columns) in enumerate(tiles):
+        shard = tile % count
+        end = offsets[shard] + _tile_area((rows, columns))
+        block = np.asarray(data[shard][offsets[shard]:end]).reshape(
+            rows.stop - rows.start, columns.stop - columns.start)
+        offsets[shard] = end
+        result[rows, columns] = block
+        result[columns, rows] = block.T
+    result.flush()
+    del result, data
+    return np.load(filename, mmap_mode='r'), process_zeroes == '1'
+
+
+class SketchEngine(DistanceEngine):
+    """
+    Approximate euclidean distances between trees from their sketches.
+
+    Sketches are dense, so computing a block of distances is a plain matrix
+    product over `width` columns, however many labels the trees have. See
+    `label_projection` for the accuracy. Distances approximate those with
+    `process_zeroes`.
+    """
+    def __init__(self, sketches):
+        self.matrix = np.asarray(sketches, dtype=np.float64)
+        self.process_zeroes = True
+        self.norms = (self.matrix ** 2).sum(axis=1)
+
+    def block(self, rows, columns):
+        """
+        Return approximate distances between two sets of rows
+        :param rows: a slice or an array of row indices
+        :param columns: a slice or an array of row indices
+        :return: an array of shape (len(rows), len(columns))
+        """
+        squared = self.matrix[rows] @ self.matrix[columns].T
+        squared *= -2
+        squared += self.norms[rows][:, None]
+        squared += self.norms[columns][None, :]
+        # Rounding errors may make the distances between equal sketches
+        # slightly negative
+        return np.sqrt(np.maximum(squared, 0))
+
+
+def write_matrix_index(filename, names, process_zeroes):
+    """
+    Write the names of distance matrix rows, one per line, after a header with
+    the settings the distances depend on
+    :param filename:
+    :param names:
+    :param process_zeroes:
+    :return:
+    """
+    with open(filename, mode='w') as outfile:
+        print('#process_zeroes\t{}'.format(int(process_zeroes)), file=outfile)
+        for name in names:
+            print(name, file=outfile)
+
+
+def read_matrix_index(filename):
+    """
+    Read a file written by `write_matrix_index`
+    :param filename:
+    :return: a tuple of a list of names and process_zeroes value
+    """
+    with open(filename) as infile:
+        header = infile.readline().rstrip('\n').split('\t')
+        if header[0] != '#process_zeroes':
+            raise ValueError('{} is not a matrix index'.format(filename))
+        return [line.rstrip('\n') for line in infile], bool(int(header[1]))
+
+
+# Labels below this are packed in pairs into single int64 keys
+PAIR_LIMIT = 1 << 31
+
+
+def _forest_array(trees, name, offsets):
+    """
+    Join an index array of many ArrayTrees into one int64 array, shifting the
+    node indices of every tree by its offset in the forest
+    :param trees:
+    :param name: 'parent', 'left' or 'right'
+    :param offsets: an array with the forest index of every node's tree start
+    :return:
+    """
+    indices = np.concatenate([np.frombuffer(getattr(x, name),
+                                            dtype=getattr(x, name).typecode)
+                              for x in trees]).astype(np.int64)
+    present = indices >= 0
+    indices[present] += offsets[present]
+    return indices
+
+
+def batch_rooted_labels(trees, label_table):
+    """
+    Return interned CP-labels for many trees at once as a label matrix.
+
+    The trees are joined into a single forest, and its nodes are labeled level
+    by level: a node joins a level as soon as both its children are labeled,
+    whichever tree it is from. For every level, the children labels are
+    gathered, ordered and deduplicated with numpy, so the LabelTable is called
+    once per distinct pair in the level rather than once per node.
+
+    Labels have to be fixed-width, so this only works with interning. The
+    labels are the same as `get_rooted_vector(tree, label_table=label_table)`
+    would return with the same table, although new pairs may be numbered in
+    a different order.
+    :param trees: a list of ArrayTrees or binary dendropy Trees
+    :param label_table: a LabelTable
+    :return: an int64 array with a row per tree and a column per node, in
+    postorder (see ArrayTree). Rows for the trees smaller than the biggest one
+    are padded with zeroes, so the vector of a tree is `row[row > 0]`
+    """
+    trees = [x if isinstance(x, ArrayTree) else ArrayTree.from_dendropy(x)
+             for x in trees]
+    if not trees:
+        return np.zeros((0, 0), dtype=np.int64)
+    sizes = np.array([len(x) for x in trees], dtype=np.int64)
+    starts = np.zeros(len(trees), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    offsets = np.repeat(starts, sizes)
+    parent = _forest_array(trees, 'parent', offsets)
+    left = _forest_array(trees, 'left', offsets)
+    right = _forest_array(trees, 'right', offsets)
+    internal = left >= 0
+    labels = np.where(internal, 0, 1).astype(np.int64)
+    # Number of children of every node that are not labeled yet
+    waiting = np.where(internal, 2, 0)
+    level = np.flatnonzero(~internal)
+    while True:
+        parents = parent[level]
+        parents = parents[parents >= 0]
+        np.subtract.at(waiting, parents, 1)
+        level = np.unique(parents)
+        level = level[waiting[level] == 0]
+        if not len(level):
+            break
+        k, j = labels[left[level]], labels[right[level]]
+        k, j = np.maximum(k, j), np.minimum(k, j)
+        if k.max() < PAIR_LIMIT:
+            # Both IDs fit in 31 bits, so a pair can be sorted as one int64
+            keys, inverse = np.unique((k << 32) | j, return_inverse=True)
+            pairs = zip((keys >> 32).tolist(), (keys & 0xffffffff).tolist())
+        else:
+            keys, inverse = np.unique(np.stack((k, j), axis=1), axis=0,
+                                      return_inverse=True)
+            pairs = keys.tolist()
+        ids = np.fromiter((label_table.combine(a, b) for a, b in pairs),
+                          dtype=np.int64, count=len(keys))
+        labels[level] = ids[inverse.reshape(-1)]
+    matrix = np.zeros((len(trees), sizes.max()), dtype=np.int64)
+    rows = np.repeat(np.arange(len(trees)), sizes)
+    columns = np.arange(len(labels)) - offsets
+    matrix[rows, columns] = labels
+    return matrix
+
+
+# LabelIndex queries with more postings than trees / DENSE_QUERY are computed
+# for all trees at once
+DENSE_QUERY = 4
+
+
+class LabelIndex:
+    """
+    An inverted index of trees by their labels, for nearest neighbour search.
+
+    Every label points to the trees that contain it along with the counts (ie
+    the index is a count matrix stored by columns), and the squared norms of
+    all trees are kept too. A query only reads the trees that share a label
+    with it. Any other tree is at sqrt(|query|^2 + |tree|^2) from the query, so
+    the nearest of them are the ones with the smallest norms, which are kept in
+    order. Distances are the same as `metrics.euclidean` gives. Labels are
+    stored as strings, so that text and binary vector files can be mixed.
+    """
+    def __init__(self, names, labels, matrix, process_zeroes=True):
+        if len(names) != matrix.shape[0] or len(labels) != matrix.shape[1]:
+            raise ValueError('Names and labels should match the matrix shape')
+        self.names = list(names)
+        self.labels = [str(label) for label in labels]
+        self.columns = {label: column
+                        for column, label in enumerate(self.labels)}
+        self.postings = csc_matrix(matrix, dtype=np.int64)
+        self.postings.sort_indices()
+        self.process_zeroes = process_zeroes
+        self.norms = np.asarray(
+            self.postings.multiply(self.postings).sum(axis=1)).ravel()
+        self.order = np.argsort(self.norms, kind='stable')
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def build(cls, named_vectors, process_zeroes=True):
+        """
+        Build an index from (name, vector) pairs
+        :param named_vectors: an iterable of (name, {label: count}) tuples, eg
+        from `vector_io.directory_vectors`, or (name, label list) tuples
+        :param process_zeroes: see `metrics.euclidean`
+        :return:
+        """
+        names = []
+
+        def counts():
+            for name, vector in named_vectors:
+                names.append(name)
+                if not isinstance(vector, dict):
+                    vector = vector_dict(vector)
+                yield {str(label): count for label, count in vector.items()}
+
+        vocabulary, matrix = count_matrix(counts())
+        return cls(names, list(vocabulary), matrix,
+                   process_zeroes=process_zeroes)
+
+    def save(self, filename):
+        """
+        Write the index to a .npz file
+        :param filename:
+        :return:
+        """
+        # A file object keeps numpy from adding the .npz extension
+        with open(filename, mode='wb') as outfile:
+            np.savez(outfile, names=np.array(self.names, dtype=str),
+                     labels=np.array(self.labels, dtype=str),
+                     indptr=self.postings.indptr,
+                     indices=self.postings.indices, counts=self.postings.data,
+                     process_zeroes=np.array(self.process_zeroes))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read an index written by `LabelIndex.save`
+        :param filename:
+        :return:
+        """
+        with np.load(filename) as data:
+            names, labels = data['names'].tolist(), data['labels'].tolist()
+            matrix = csc_matrix((data['counts'], data['indices'],
+                                 data['indptr']),
+                                shape=(len(names), len(labels)))
+            return cls(names, labels, matrix,
+                       process_zeroes=bool(data['process_zeroes']))
+
+    def query(self, vector, k=10):
+        """
+        Return the k trees nearest to a given one
+        :param vector: a {label: count} dict or a list of labels
+        :param k:
+        :return: a list of (name, distance) tuples, nearest first. Ties are
+        broken by the order of trees in the index
+        """
+        if not isinstance(vector, dict):
+            vector = vector_dict(vector)
+        query_norm = 0
+        columns = []
+        values = []
+        for label, count in vector.items():
+            column = self.columns.get(str(label))
+            if column is None:
+                if self.process_zeroes:
+                    query_norm += count ** 2
+            else:
+                columns.append(column)
+                values.append(count)
+        # The postings of query labels, as (tree, count, query count) triples
+        postings = self.postings[:, columns]
+        trees = postings.indices
+        counts = postings.data
+        query_counts = np.repeat(np.asarray(values, dtype=np.int64),
+                                 np.diff(postings.indptr))
+        if len(trees) * DENSE_QUERY > len(self):
+            # Common labels, like the leaf one, are in almost every tree. Then
+            # it is faster to add up the postings for all trees than to sort
+            candidates = np.arange(len(self))
+            inverse = trees
+            others = candidates[:0]
+        else:
+            candidates, inverse = np.unique(trees, return_inverse=True)
+            # Trees without common labels, nearest first. Without
+            # process_zeroes they are all at zero distance
+            ranking = self.order if self.process_zeroes \
+                else np.arange(len(self))
+            others = ranking[:k + len(candidates)]
+            others = others[np.isin(others, candidates, assume_unique=True,
+                                    invert=True)][:k]
+        if self.process_zeroes:
+            query_norm += sum(x ** 2 for x in values)
+            dots = np.bincount(inverse, weights=counts * query_counts,
+                               minlength=len(candidates))
+            squared = np.concatenate((
+                query_norm + self.norms[candidates] - 2 * dots,
+                query_norm + self.norms[others]))
+        else:
+            squared = np.concatenate((
+                np.bincount(inverse, weights=(counts - query_counts) ** 2,
+                            minlength=len(candidates)),
+                np.zeros(len(others))))
+        trees = np.concatenate((candidates, others))
+        if len(squared) > k:
+            # Only the trees up to the k-th distance, ties included, are sorted
+            kth = np.partition(squared, k - 1)[k - 1]
+            close = np.flatnonzero(squared <= kth)
+            trees, squared = trees[close], squared[close]
+        nearest = np.lexsort((trees, squared))[:k]
+        return [(self.names[trees[x]], sqrt(squared[x])) for x in nearest]
+
+
+# Sketches
+
+def label_projection(labels, width, seed=0):
+    """
+    Return the random projection rows for a list of labels.
+
+    A sketch of a tree is the sum of the rows of its labels, times their
+    counts, ie its count vector multiplied by a random matrix with
+    N(0, 1/width) entries. Every row is generated from a hash of its label and
+    the seed, so sketches made in different processes and runs can be compared
+    as long as width and seed are the same. Labels are hashed as strings, so
+    text and binary vectors of the same tree get the same sketch.
+
+    By the Johnson-Lindenstrauss lemma, squared distances between sketches are
+    unbiased estimates of the squared distances between vectors, with relative
+    standard deviation sqrt(2 / width). For one pair of trees the squared
+    distance is off by more than a factor of (1 +- eps) with the probability
+    of at most 2 exp(-width (eps^2 / 2 - eps^3 / 3) / 2); see `sketch_width`
+    to choose a width for a whole collection.
+    :param labels:
+    :param width: sketch size
+    :param seed:
+    :return: a float64 array of shape (len(labels), width)
+    """
+    rows = np.empty((len(labels), width))
+    for position, label in enumerate(labels):
+        key = blake2b('{}\t{}'.format(seed, label).encode(),
+                      digest_size=8).digest()
+        generator = np.random.default_rng(int.from_bytes(key, 'little'))
+        rows[position] = generator.standard_normal(width)
+    rows /= sqrt(width)
+    return rows
+
+
+def sketch_width(count, eps=0.2, failure=0.05):
+    """
+    Return a sketch width that keeps all squared distances between `count`
+    trees within a factor of (1 +- eps) with probability 1 - failure, from the
+    Johnson-Lindenstrauss bound. Distances themselves are then within
+    sqrt(1 +- eps). The bound is conservative, and smaller widths often do
+    well enough for exploration.
+    :param count: number of trees
+    :param eps: relative error of squared distances, below 1
+    :param failure: probability that any pair is off by more
+    :return:
+    """
+    if not 0 < eps < 1:
+        raise ValueError('eps should be between 0 and 1')
+    pairs = max(count * (count - 1) // 2, 1)
+    return int(ceil(2 * log(2 * pairs / failure) /
+                    (eps ** 2 / 2 - eps ** 3 / 3)))
+
+
+def sketch_matrix(matrix, labels, width, seed=0):
+    """
+    Return sketches for all rows of a label count matrix
+    :param matrix: a count matrix, eg from `count_matrix`
+    :param labels: labels of the matrix columns, eg a count_matrix vocabulary
+    :param width:
+    :param seed:
+    :return: a float64 array of shape (rows, width)
+    """
+    return np.asarray(csr_matrix(matrix) @
+                      label_projection(list(labels), width, seed))
+
+
+def sketch_vector(vector, width, seed=0):
+    """
+    Return the sketch of a single vector
+    :param vector: a {label: count} dict or a list of labels
+    :param width:
+    :param seed:
+    :return:
+    """
+    if not isinstance(vector, dict):
+        vector = vector_dict(vector)
+    counts = np.fromiter(vector.values(), dtype=np.float64, count=len(vector))
+    return counts @ label_projection(list(vector), width, seed)
+
+
+# Multidimensional scaling
+
+def _top_eigenvectors(matrix, dimensions):
+    """
+    Return the largest eigenvalues and their eigenvectors of a symmetric
+    matrix, in decreasing order
+    :param matrix: an array or a LinearOperator
+    :param dimensions:
+    :return:
+    """
+    if dimensions < matrix.shape[0] - 1:
+        values, vectors = eigsh(matrix, k=dimensions, which='LA')
+    else:
+        # Too few points for the sparse solver
+        if isinstance(matrix, LinearOperator):
+            matrix = matrix @ np.eye(matrix.shape[0])
+        values, vectors = np.linalg.eigh(matrix)
+        values, vectors = values[-dimensions:], vectors[:, -dimensions:]
+    order = np.argsort(values)[::-1]
+    return values[order], vectors[:, order]
+
+
+def _embedding(values, vectors):
+    """
+    Return coordinates from eigenvalues and eigenvectors of a Gram matrix
+    :param values:
+    :param vectors:
+    :return:
+    """
+    # Negative eigenvalues come from non-euclidean noise and are dropped
+    return vectors * np.sqrt(np.maximum(values, 0))
+
+
+def classical_mds(distances, dimensions=2, batch_size=1024, weights=None):
+    """
+    Classical (Torgerson) MDS: embed points so that the euclidean distances
+    between them approximate the given ones.
+
+    The embedding is made of the top eigenvectors of the double centered
+    matrix of squared distances, found with a truncated eigendecomposition.
+    That matrix is never formed: it is applied to vectors reading the distances
+    in blocks of rows, so `distances` may be a memmap bigger than RAM, eg from
+    `DistanceEngine.distance_file`.
+
+    With weights, every point stands for that many identical ones, and the
+    result is the same as for the matrix with all the copies, only smaller.
+    :param distances: a symmetric matrix of distances
+    :param dimensions: number of dimensions of the embedding
+    :param batch_size: number of distance matrix rows read at once
+    :param weights: numbers of copies of every point, all ones by default
+    :return: an array of shape (points, dimensions)
+    """
+    size = distances.shape[0]
+    weights = np.ones(size) if weights is None \
+        else np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+    roots = np.sqrt(weights)
+
+    def centered_product(vectors):
+        # W^1/2 B W^1/2 x, where B = -1/2 J D^2 J' with J = I - 1 w' / sum(w)
+        # centering the points with their weights, and D^2 squared distances
+        vectors = vectors.reshape(size, -1) * roots[:, None]
+        vectors = vectors - weights[:, None] * (vectors.sum(axis=0) / total)
+        result = np.empty_like(vectors)
+        for start in range(0, size, batch_size):
+            rows = slice(start, start + batch_size)
+            result[rows] = (np.asarray(distances[rows], dtype=np.float64)
+                            ** 2) @ vectors
+        result -= weights @ result / total
+        return -0.5 * roots[:, None] * result
+
+    operator = LinearOperator((size, size), matvec=centered_product,
+                              matmat=centered_product, dtype=np.float64)
+    values, vectors = _top_eigenvectors(operator, dimensions)
+    return _embedding(values, vectors / roots[:, None])
+
+
+def unique_rows(matrix):
+    """
+    Find identical rows of a count or sketch matrix, eg the trees with the
+    same topology.
+    :param matrix: a scipy.sparse or a dense matrix
+    :return: a tuple of the indices of the first row of every kind, in order,
+    and an array with the position of every row's kind in the former
+    """
+    if not issparse(matrix):
+        _, first, inverse = np.unique(np.asarray(matrix), axis=0,
+                                      return_index=True, return_inverse=True)
+        # np.unique sorts rows by value, not by their first occurrence
+        order = np.argsort(first)
+        positions = np.empty_like(order)
+        positions[order] = np.arange(len(order))
+        return first[order], positions[inverse.reshape(-1)]
+    matrix = csr_matrix(matrix)
+    matrix.sort_indices()
+    indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+    kinds = {}
+    first = []
+    inverse = np.empty(matrix.shape[0], dtype=np.int64)
+    for row in range(matrix.shape[0]):
+        start, end = indptr[row], indptr[row + 1]
+        key = indices[start:end].tobytes(), data[start:end].tobytes()
+        position = kinds.setdefault(key, len(first))
+        if position == len(first):
+            first.append(row)
+        inverse[row] = position
+    return np.array(first, dtype=np.int64), inverse
+
+
+def choose_landmarks(engine, count, seed=0, batch_size=1024):
+    """
+    Choose landmark rows for landmark MDS by the maxmin rule: starting from a
+    random one, every next landmark is the row farthest from all chosen ones.
+    This spreads landmarks over the whole set, outliers included.
+    :param engine: a DistanceEngine or SketchEngine
+    :param count: number of landmarks
+    :param seed:
+    :param batch_size: number of rows per distance block
+    :return: a tuple of the landmark indices and an array of distances from
+    every row to every landmark, of shape (rows, landmarks)
+    """
+    size = len(engine)
+    count = min(count, size)
+    landmarks = [int(np.random.default_rng(seed).integers(size))]
+    distances = np.zeros((size, count))
+    closest = np.full(size, np.inf)
+    for position in range(count):
+        column = np.array(landmarks[-1:])
+        for start in range(0, size, batch_size):
+            rows = slice(start, min(start + batch_size, size))
+            distances[rows, position] = engine.block(rows, column)[:, 0]
+        np.minimum(closest, distances[:, position], out=closest)
+        if position + 1 < count:
+            closest[landmarks] = -1
+            landmarks.append(int(np.argmax(closest)))
+    return np.array(landmarks), distances
+
+
+def landmark_mds(engine, landmarks=500, dimensions=2, seed=0,
+                 batch_size=1024):
+    """
+    Landmark MDS (de Silva and Tenenbaum, 2004): classical MDS of a few
+    landmark rows, and all the other rows placed by their distances to the
+    landmarks only.
+
+    Only the distances from every row to the landmarks are computed, which
+    takes O(N L) instead of O(N^2) time and memory. With as many landmarks as
+    rows this is classical MDS.
+    :param engine: a DistanceEngine or SketchEngine
+    :param landmarks: number of landmarks, more than `dimensions`
+    :param dimensions: number of dimensions of the embedding
+    :param seed: random seed for the first landmark
+    :param batch_size: number of rows per distance block
+    :return: an array of shape (rows, dimensions)
+    """
+    indices, distances = choose_landmarks(engine, landmarks, seed=seed,
+                                          batch_size=batch_size)
+    squared = distances ** 2
+    landmark_squared = squared[indices]
+    count = len(indices)
+    centering = np.eye(count) - 1 / count
+    gram = -0.5 * centering @ landmark_squared @ centering
+    values, vectors = _top_eigenvectors(gram, min(dimensions, count))
+    # Triangulation from the landmarks. Dimensions with zero eigenvalues,
+    # which landmarks do not span, get zero coordinates
+    positive = values > values.max(initial=0) * 1e-12
+    pseudoinverse = np.zeros_like(vectors)
+    pseudoinverse[:, positive] = vectors[:, positive] / \
+        np.sqrt(values[positive])
+    return -0.5 * (squared - landmark_squared.mean(axis=0)) @ pseudoinverse